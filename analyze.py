@@ -1,10 +1,24 @@
 #!/usr/bin/env python
 
 from pathlib import Path
+import logging
 import nbrun
+import joblog
 
 default_notebook_name = 'smFRET-PAX_single_pop.ipynb'
 
+# CSV file (in the data folder) collecting the results emitted by the
+# analysis notebooks (see `nbrun.emit_result()` and `nbrun.load_results()`)
+results_fname = 'analysis_results.csv'
+
+log = logging.getLogger(__name__)
+
+
+def get_log_path(data_filename, suffix=''):
+    """Return the path of the log file for the analysis of `data_filename`."""
+    return Path(data_filename.parent,
+                data_filename.stem + suffix + '_analysis.log')
+
 
 def run_analysis(data_filename, input_notebook=None, save_html=False,
                  working_dir=None, suffix='', dry_run=False):
@@ -18,10 +32,13 @@ def run_analysis(data_filename, input_notebook=None, save_html=False,
         working_dir (Path or None): working dir the kernel is started into.
             If None (default), use the same folder as the data file.
         dry_run (bool): just pretenting. Do not run or save any notebook.
+
+    Results emitted by the notebook with `nbrun.emit_result()` are appended
+    to the file `results_fname` in the folder of the data file.
     """
     if input_notebook is None:
         input_notebook = default_notebook_name
-    print(' * Running analysis for %s' % (data_filename.stem), flush=True)
+    log.info(' * Running analysis for %s' % (data_filename.stem))
     if working_dir is None:
         working_dir = data_filename.parent
     out_path_html = Path(data_filename.parent, 'reports_html',
@@ -34,8 +51,10 @@ def run_analysis(data_filename, input_notebook=None, save_html=False,
                            out_path_ipynb=out_path_nb,
                            out_path_html=out_path_html,
                            nb_kwargs={'fname': str(data_filename)},
-                           save_html=save_html, working_dir=working_dir)
-    print('   [COMPLETED ANALYSIS] %s' % (data_filename.stem), flush=True)
+                           save_html=save_html, working_dir=working_dir,
+                           results_path=Path(data_filename.parent, results_fname),
+                           results_key=str(data_filename))
+    log.info('   [COMPLETED ANALYSIS] %s' % (data_filename.stem))
 
 
 if __name__ == '__main__':
@@ -63,5 +82,10 @@ if __name__ == '__main__':
     assert datafile.is_file(), 'Data file not found: %s' % datafile
     notebook = Path(args.notebook)
     assert notebook.is_file(), 'Notebook not found: %s' % notebook
-    run_analysis(datafile, input_notebook=notebook, suffix=args.suffix,
-                 save_html=args.save_html, working_dir=args.working_dir)
+    log_queue, listener = joblog.start_logging()
+    try:
+        with joblog.job(datafile.stem, get_log_path(datafile, args.suffix)):
+            run_analysis(datafile, input_notebook=notebook, suffix=args.suffix,
+                         save_html=args.save_html, working_dir=args.working_dir)
+    finally:
+        listener.stop()
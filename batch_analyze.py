@@ -2,9 +2,18 @@
 
 import sys
 from pathlib import Path
+import logging
 from multiprocessing import Pool
 
-from analyze import run_analysis, default_notebook_name
+from analyze import run_analysis, default_notebook_name, get_log_path
+from prefetch import Prefetcher
+from ratelimit import MB
+import joblog
+import status
+import capacity
+
+
+log = logging.getLogger(__name__)
 
 
 def get_file_list(folder, glob='*.hdf5'):
@@ -13,32 +22,84 @@ def get_file_list(folder, glob='*.hdf5'):
             if not f.stem.endswith('_cache')]
 
 
+def analyze_file(data_filename, notebook=None, save_html=False,
+                 working_dir=None, suffix=''):
+    """Run the analysis on a file, saving a log file next to it."""
+    size = data_filename.stat().st_size
+    with joblog.job(data_filename.stem, get_log_path(data_filename, suffix)):
+        status.report('job_start')
+        try:
+            with status.stage('analyze', size, data_filename.suffix):
+                run_analysis(data_filename, input_notebook=notebook,
+                             save_html=save_html, working_dir=working_dir,
+                             suffix=suffix)
+        except Exception:
+            log.exception('Analysis of "%s" failed:' % data_filename)
+            status.report('job_failed')
+            raise
+        status.report('job_end', nbytes=size)
+
+
 def batch_process(folder, nproc=4, notebook=None, save_html=False,
                   working_dir='./', interactive=False, glob='*.hdf5',
-                  suffix=''):
+                  suffix='', prefetch=2, prefetch_mem=None):
+    """Run the analysis notebook on all the files in `folder`.
+
+    While the first `nproc` files are analyzed, the next `prefetch` files
+    in the queue are read ahead to warm the page cache (see `Prefetcher`),
+    using at most `prefetch_mem` bytes of memory (default half of the
+    available memory). Use `prefetch=0` to disable the read-ahead.
+    """
     assert folder.is_dir(), 'Path not found: %s' % folder
 
     title_msg = 'Processing files in folder: %s' % folder.name
-    print('\n\n%s' % title_msg)
+    log.info(title_msg)
 
     if interactive:
         filelist = get_file_selection_from_user(folder, glob=glob)
     else:
         filelist = get_file_list(folder, glob=glob)
 
-    print('\n- The following files will be processed:')
-    for f in filelist:
-        print('  %s' % f)
-    print()
+    log.info('- The following files will be processed:\n' +
+             '\n'.join('  %s' % f for f in filelist))
 
-    with Pool(processes=nproc) as pool:
+    prefetcher = Prefetcher(filelist, skip=nproc, depth=prefetch,
+                            mem_budget=prefetch_mem)
+    with Pool(processes=nproc, initializer=joblog.init_worker,
+              initargs=(joblog.log_queue,)) as pool:
         try:
-            pool.starmap(run_analysis,
-                         [(f, notebook, save_html, working_dir, suffix)
-                          for f in filelist])
+            if prefetch > 0:
+                prefetcher.start()
+            results = []
+            for f in filelist:
+                status.report('job_queued', job=f.stem, kind=f.suffix)
+                done = lambda _, f=f: prefetcher.done(f)
+                results.append(pool.apply_async(
+                    analyze_file, (f, notebook, save_html, working_dir, suffix),
+                    callback=done, error_callback=done))
+            for res in results:
+                res.wait()
+            for res in results:
+                res.get()
+            # Let workers exit cleanly to flush their queued log records
+            pool.close()
+            pool.join()
         except KeyboardInterrupt:
-            print('\n>>> Got keyboard interrupt.\n', flush=True)
-    print('Closing subprocess pool.', flush=True)
+            log.warning('>>> Got keyboard interrupt.')
+        finally:
+            prefetcher.stop()
+    log.info('Closing subprocess pool.')
+
+
+def estimate(folder, nproc=4, glob='*.hdf5', nproc_options=(1, 2, 4, 8)):
+    """Predict the duration of the batch analysis for several `nproc`."""
+    filelist = get_file_list(folder, glob=glob)
+    if len(filelist) == 0:
+        log.info('No data files found in %s' % folder)
+        return
+    configs = [dict(nprocs=dict(analysis=n))
+               for n in sorted(set(nproc_options) | {nproc})]
+    return capacity.estimate(filelist, configs)
 
 
 def get_file_selection_from_user(path, glob='*.hdf5'):
@@ -129,6 +190,27 @@ if __name__ == '__main__':
                         help=msg)
     parser.add_argument('--suffix', metavar='STRING', default='',
                         help='Notebook name suffix.')
+    msg = ("Number of queued files to read ahead (in the page cache) while "
+           "the current files are analyzed. Use 0 to disable. Default 2.")
+    parser.add_argument('--prefetch', metavar='K', type=int, default=2,
+                        help=msg)
+    msg = ("Max memory (MB) used for reading files ahead. "
+           "Default half of the available memory.")
+    parser.add_argument('--prefetch-mem', metavar='MB', type=float,
+                        default=None, help=msg)
+    msg = ("Do not process any file. Predict the duration of the batch for "
+           "several numbers of workers, using the timings recorded in "
+           "previous batches.")
+    parser.add_argument('--estimate', action='store_true', help=msg)
+    msg = "Do not show the progress bar."
+    parser.add_argument('--no-progress', action='store_true', help=msg)
+    msg = ("Periodically save the status (progress, throughput, ETA) "
+           "in this JSON file.")
+    parser.add_argument('--status-file', metavar='PATH', default=None,
+                        help=msg)
+    msg = "Serve the status as JSON on http://localhost:PORT/."
+    parser.add_argument('--status-port', metavar='PORT', type=int,
+                        default=None, help=msg)
     args = parser.parse_args()
 
     folder = Path(args.folder)
@@ -137,11 +219,32 @@ if __name__ == '__main__':
     elif not folder.is_dir():
         sys.exit('\nYou must provide a folder (not a file) as an argument.\n')
 
+    if args.estimate:
+        log_queue, listener = joblog.start_logging()
+        try:
+            estimate(folder, nproc=args.num_processes, glob=args.glob[1:-1])
+        finally:
+            listener.stop()
+        sys.exit()
+
+    tracker = status.StatusTracker(nproc=args.num_processes,
+                                   status_file=args.status_file,
+                                   port=args.status_port,
+                                   progress=not args.no_progress)
+    recorder = capacity.TimingRecorder()
+    log_queue, listener = joblog.start_logging(handlers=[tracker, recorder])
+    tracker.start()
     try:
         batch_process(folder, nproc=args.num_processes, notebook=args.notebook,
                       save_html=args.save_html, working_dir=args.working_dir,
                       interactive=args.choose_files, glob=args.glob[1:-1],
-                      suffix=args.suffix)
-        print('Batch analysis completed.', flush=True)
+                      suffix=args.suffix, prefetch=args.prefetch,
+                      prefetch_mem=(None if args.prefetch_mem is None
+                                    else args.prefetch_mem * MB))
+        log.info('Batch analysis completed.')
     except KeyboardInterrupt:
         sys.exit('\n\nExecution terminated.\n')
+    finally:
+        listener.stop()
+        tracker.stop()
+        recorder.close()
@@ -1,11 +1,35 @@
 #!/usr/bin/env python
 
 import sys
+import shutil
 from pathlib import Path
 import time
+import logging
+import threading
+from collections import deque
+from contextlib import ExitStack
 from multiprocessing import Pool
 
 import transfer
+from ratelimit import GrowingFileWatcher
+from prefetch import get_available_memory
+import preflight
+import joblog
+import status
+import capacity
+
+
+log = logging.getLogger(__name__)
+
+
+# Resource class of each data file type: 48-spot files (.dat) are large and
+# their conversion is heavy, single-spot files (.sm) are small and fast.
+# Each class runs in a separate pool so light jobs never wait for heavy ones.
+resource_classes = {'.dat': 'heavy', '.sm': 'light'}
+
+# Memory needed by a heavy job, as multiple of the data file size
+# (ramdisk copy of the data, output files and conversion process)
+heavy_job_mem_factor = 3
 
 
 def get_new_files(folder, init_filelist=None, glob='**/*.dat'):
@@ -16,65 +40,322 @@ def get_new_files(folder, init_filelist=None, glob='**/*.dat'):
             if (f.with_suffix('.yml').is_file() and f not in init_filelist)]
 
 
+def get_data_files(folder, init_filelist=None, extensions=None):
+    """Return new data files of all the types in `resource_classes`."""
+    if extensions is None:
+        extensions = resource_classes.keys()
+    return [f for ext in extensions
+            for f in get_new_files(folder, init_filelist, glob='*' + ext)]
+
+
+def get_conversion_notebooks(conversion_notebook, singlespot_notebook):
+    """Return a dict with the conversion notebook for each file type.
+
+    For backward compatibility, a single-spot notebook (name containing
+    ' SM') passed as `conversion_notebook` is used for the .sm files, and the
+    .dat files use the default 48-spot notebook. Raises ValueError if
+    `singlespot_notebook` is also set to a different notebook.
+    """
+    if ' SM' in conversion_notebook:
+        if singlespot_notebook not in (transfer.convert_notebook_name_singlespot,
+                                       conversion_notebook):
+            raise ValueError(
+                f'Single-spot notebook "{conversion_notebook}" passed as '
+                'conversion notebook together with a different single-spot '
+                f'notebook "{singlespot_notebook}". Pass only the latter.')
+        log.warning(f'- Notebook "{conversion_notebook}" used for single-spot '
+                    '(.sm) files. Passing a single-spot notebook as conversion '
+                    'notebook is deprecated, use the single-spot notebook '
+                    'option instead. 48-spot (.dat) files are converted with '
+                    f'"{transfer.convert_notebook_name_inplace}".')
+        singlespot_notebook = conversion_notebook
+        conversion_notebook = transfer.convert_notebook_name_inplace
+    return {'.dat': conversion_notebook, '.sm': singlespot_notebook}
+
+
+def max_heavy_jobs(filelist, nproc):
+    """Number of heavy jobs which can run in parallel within the memory.
+
+    Memory is estimated as `heavy_job_mem_factor` times the size of the
+    largest file. Returns at least 1 and at most `nproc`.
+    """
+    sizes = [f.stat().st_size for f in filelist
+             if resource_classes.get(f.suffix) == 'heavy']
+    mem_available = get_available_memory()
+    if len(sizes) == 0 or mem_available is None:
+        return nproc
+    max_jobs = int(mem_available // (max(sizes) * heavy_job_mem_factor))
+    return max(1, min(nproc, max_jobs))
+
+
+class MemoryGate:
+    """Admit heavy jobs while their estimated memory fits in a budget.
+
+    Used in monitor mode, where the files are not known in advance. Each
+    job needs `heavy_job_mem_factor` times the size of its data file. Jobs
+    are admitted in FIFO order and at least one job is always admitted.
+
+    Arguments:
+        mem_budget (int or None): memory (bytes) available to the jobs.
+            If None, jobs are not limited.
+    """
+    def __init__(self, mem_budget=None):
+        self.mem_budget = mem_budget
+        self.pending = deque()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def add(self, fname):
+        """Queue a data file until its job can be admitted."""
+        self.pending.append(fname)
+
+    def admit(self):
+        """Return the queued files which can be started now."""
+        admitted = []
+        with self._lock:
+            while self.pending:
+                mem = self.pending[0].stat().st_size * heavy_job_mem_factor
+                used = sum(self._in_flight.values())
+                if (self.mem_budget is not None and len(self._in_flight) > 0
+                        and used + mem > self.mem_budget):
+                    break
+                fname = self.pending.popleft()
+                self._in_flight[fname] = mem
+                admitted.append(fname)
+        return admitted
+
+    def done(self, fname):
+        """Release the memory of a completed (or failed) job."""
+        with self._lock:
+            self._in_flight.pop(fname, None)
+
+
+def get_ramdisk_size():
+    """Return the size (bytes) of the ramdisk (inf if not found)."""
+    temp_dir = Path(transfer.temp_basedir)
+    if not temp_dir.is_dir():
+        return float('inf')
+    return shutil.disk_usage(str(temp_dir)).total
+
+
+def estimate(folder, nproc=4, nproc_light=2, analyze=True, remove=True,
+             nproc_options=(1, 2, 4, 8)):
+    """Predict the duration of a batch for several configurations.
+
+    Only the file sizes are read, no file is processed. The cost of each
+    stage comes from the timings recorded during previous batches
+    (see `capacity`).
+    """
+    filelist = get_data_files(folder)
+    if len(filelist) == 0:
+        log.info('No data files found in %s' % folder)
+        return
+    configs = [dict(nprocs=dict(heavy=max_heavy_jobs(filelist, n),
+                                light=nproc_light), staged=staged)
+               for n in sorted(set(nproc_options) | {nproc})
+               for staged in (True, False)]
+    return capacity.estimate(filelist, configs,
+                             resource_classes=resource_classes,
+                             remove=remove, analyze=analyze,
+                             ramdisk_size=get_ramdisk_size())
+
+
+def make_pools(stack, nprocs, rate_limiters):
+    """Create a pool for each resource class in `nprocs` {class: nproc}.
+
+    Pools are added to the `ExitStack` `stack`.
+    """
+    return {res_class: stack.enter_context(
+                Pool(processes=nproc, initializer=transfer.init_worker,
+                     initargs=(rate_limiters, joblog.log_queue)))
+            for res_class, nproc in nprocs.items() if nproc > 0}
+
+
 def complete_task(fname, dry_run=False):
-    print('Completed processing for "%s" (callback)' % fname, flush=True)
+    log.debug('Completed processing for "%s" (callback)' % fname)
 
 
-def start_monitoring(folder, dry_run=False, nproc=4, inplace=False,
-                     analyze=True, remove=True, analyze_kws=None,
-                     singlespot=False):
+def get_signature(datafile):
+    """Return (metadata mtime, data size, data mtime) of a data file."""
+    data_stat = datafile.stat()
+    return (datafile.with_suffix('.yml').stat().st_mtime,
+            data_stat.st_size, data_stat.st_mtime)
+
+
+def update_rate_limits(rate_limiters, busy, rate_limits=None):
+    """Set the rate of each limiter to the "busy" or "idle" value."""
+    if rate_limits is None:
+        rate_limits = transfer.copy_rate_limits
+    for basedir, bucket in rate_limiters.items():
+        idle_rate, busy_rate = rate_limits[basedir]
+        rate = busy_rate if busy else idle_rate
+        if rate != bucket.rate:
+            bucket.set_rate(rate)
+            log.info('- Copy rate for "%s" set to %s (acquisition %s)' %
+                     (basedir, 'unlimited' if rate is None else
+                      '%.1f MB/s' % (rate / transfer.MB),
+                      'running' if busy else 'idle'))
+
+
+def start_monitoring(folder, dry_run=False, nproc=4, analyze=True,
+                     analyze_kws=None, remove=True,
+                     conversion_notebook=transfer.convert_notebook_name_inplace,
+                     check_metadata=True, staging_mode='always',
+                     singlespot_notebook=transfer.convert_notebook_name_singlespot,
+                     nproc_light=2):
+    assert nproc >= 1 and nproc_light >= 1, 'At least 1 worker per pool.'
     title_msg = 'Monitoring files in folder: %s' % folder.name
-    print('\n\n%s' % title_msg)
+    log.info(title_msg)
+
+    init_filelist = get_data_files(folder)
 
-    glob = '*.sm' if singlespot else '*.dat'
-    init_filelist = get_new_files(folder, glob=glob)
+    log.info('- The following files are present at startup and will be '
+             'skipped:\n' + '\n'.join('  %s' % f for f in init_filelist))
 
-    print('- The following files are present at startup and will be skipped:')
-    for f in init_filelist:
-        print('  %s' % f)
-    print()
+    # Copies from the acquisition share are throttled while the
+    # acquisition is writing new data files in the monitored folder
+    watchers = [GrowingFileWatcher(folder, glob='*' + ext)
+                for ext in resource_classes]
+    rate_limiters = transfer.make_rate_limiters()
 
-    args = [dry_run, inplace, analyze, remove, analyze_kws, singlespot]
-    with Pool(processes=nproc) as pool:
+    # Rejected files are checked again only when their metadata or data
+    # file changes (e.g. a data file picked up while still being written)
+    rejected_signatures = {}
+
+    # Files are not known in advance: heavy jobs start only when their
+    # memory fits in the memory available at startup
+    gate = MemoryGate(get_available_memory())
+    notebooks = get_conversion_notebooks(conversion_notebook,
+                                         singlespot_notebook)
+    args = [dry_run, analyze, analyze_kws, remove]
+
+    def submit(pool, fname, gate=None):
+        def done(result, fname=fname):
+            if gate is not None:
+                gate.done(fname)
+            complete_task(result)
+        pool.apply_async(transfer.process_int,
+                         [fname] + args + [notebooks[fname.suffix],
+                                           staging_mode],
+                         callback=done, error_callback=done)
+
+    with ExitStack() as stack:
+        pools = make_pools(stack, dict(heavy=nproc, light=nproc_light),
+                           rate_limiters)
         try:
             while True:
                 transfer.timestamp()
                 for i in range(20):
                     time.sleep(3)
-                    newfiles = get_new_files(folder, init_filelist, glob=glob)
+                    growing = set()
+                    for watcher in watchers:
+                        growing.update(watcher.growing())
+                    update_rate_limits(rate_limiters, busy=len(growing) > 0)
+                    newfiles = get_data_files(folder, init_filelist)
+                    if check_metadata:
+                        # Files still being written are checked (and
+                        # processed) after the acquisition completes
+                        newfiles = [f for f in newfiles
+                                    if f not in growing and
+                                    get_signature(f) !=
+                                    rejected_signatures.get(f)]
+                        results = [preflight.validate(f) for f in newfiles]
+                        rejected = {f: errors for f, errors in results
+                                    if len(errors) > 0}
+                        if len(rejected) > 0:
+                            preflight.log_report(rejected)
+                        for f in rejected:
+                            rejected_signatures[f] = get_signature(f)
+                        newfiles = [f for f in newfiles if f not in rejected]
                     for newfile in newfiles:
-                        pool.apply_async(transfer.process_int,
-                                         [newfile] + args,
-                                         callback=complete_task)
+                        status.report('job_queued', job=newfile.stem,
+                                      kind=newfile.suffix)
+                        if resource_classes[newfile.suffix] == 'heavy':
+                            gate.add(newfile)
+                        else:
+                            submit(pools['light'], newfile)
+                    for newfile in gate.admit():
+                        submit(pools['heavy'], newfile, gate)
+                    held = [f for f in newfiles if f in gate.pending]
+                    if len(held) > 0:
+                        log.info('- Waiting for memory to start: %s' %
+                                 ', '.join(f.name for f in held))
                     init_filelist += newfiles
         except KeyboardInterrupt:
-            print('\n>>> Got keyboard interrupt.\n', flush=True)
-    print('Closing subprocess pool.', flush=True)
+            log.warning('>>> Got keyboard interrupt.')
+    log.info('Closing subprocess pool.')
 
 
 def batch_process(folder, dry_run=False, nproc=4, analyze=True,
                   analyze_kws=None, remove=True,
-                  conversion_notebook=transfer.convert_notebook_name_inplace):
+                  conversion_notebook=transfer.convert_notebook_name_inplace,
+                  check_metadata=True, staging_mode='always',
+                  singlespot_notebook=transfer.convert_notebook_name_singlespot,
+                  nproc_light=2):
+    """Process all the data files in `folder`.
+
+    48-spot (.dat) and single-spot (.sm) files are converted with their own
+    notebook (`conversion_notebook` and `singlespot_notebook`) in two
+    separate pools with `nproc` and `nproc_light` workers. The number of
+    heavy (48-spot) workers is reduced if there is not enough memory
+    (see `max_heavy_jobs()`).
+    """
     assert folder.is_dir(), 'Path not found: %s' % folder
+    assert nproc >= 1 and nproc_light >= 1, 'At least 1 worker per pool.'
 
     title_msg = 'Processing files in folder: %s' % folder.name
-    print('\n\n%s' % title_msg)
+    log.info(title_msg)
+
+    filelist = get_data_files(folder)
 
-    glob = '*.sm' if ' SM' in conversion_notebook else '*.dat'
-    filelist = get_new_files(folder, glob=glob)
+    if check_metadata:
+        filelist, rejected = preflight.validate_files(filelist, nproc=nproc)
+        preflight.log_report(rejected)
 
-    print('- The following files will be processed in batch:')
-    for f in filelist:
-        print('  %s' % f)
-    print()
+    log.info('- The following files will be processed in batch:\n' +
+             '\n'.join('  %s' % f for f in filelist))
 
-    args = [dry_run, analyze, analyze_kws, remove, conversion_notebook]
-    with Pool(processes=nproc) as pool:
+    nprocs = dict(heavy=max_heavy_jobs(filelist, nproc), light=nproc_light)
+    if nprocs['heavy'] < nproc:
+        log.info('- Heavy jobs limited to %d (available memory).'
+                 % nprocs['heavy'])
+    jobs = {res_class: [f for f in filelist
+                        if resource_classes[f.suffix] == res_class]
+            for res_class in nprocs}
+    nprocs = {res_class: n if len(jobs[res_class]) > 0 else 0
+              for res_class, n in nprocs.items()}
+
+    if dry_run and len(filelist) > 0:
+        # Pools without files are not created
+        used_nprocs = {res_class: n for res_class, n in nprocs.items() if n > 0}
+        capacity.estimate(filelist, [dict(nprocs=used_nprocs,
+                                          staged=staging_mode != 'never')],
+                          resource_classes=resource_classes, remove=remove,
+                          analyze=analyze, ramdisk_size=get_ramdisk_size())
+
+    rate_limiters = transfer.make_rate_limiters()
+    notebooks = get_conversion_notebooks(conversion_notebook,
+                                         singlespot_notebook)
+    args = [dry_run, analyze, analyze_kws, remove]
+    with ExitStack() as stack:
+        pools = make_pools(stack, nprocs, rate_limiters)
         try:
-            pool.starmap(transfer.process_int, [[f] + args for f in filelist])
+            for f in filelist:
+                status.report('job_queued', job=f.stem, kind=f.suffix)
+            results = [pool.starmap_async(transfer.process_int,
+                                          [[f] + args + [notebooks[f.suffix],
+                                                         staging_mode]
+                                           for f in jobs[res_class]])
+                       for res_class, pool in pools.items()]
+            for res in results:
+                res.get()
+            # Let workers exit cleanly to flush their queued log records
+            for pool in pools.values():
+                pool.close()
+                pool.join()
         except KeyboardInterrupt:
-            print('\n>>> Got keyboard interrupt.\n', flush=True)
-    print('Closing subprocess pool.', flush=True)
+            log.warning('>>> Got keyboard interrupt.')
+    log.info('Closing subprocess pool.')
 
 
 if __name__ == '__main__':
@@ -105,13 +386,32 @@ if __name__ == '__main__':
 
     parser.add_argument('folder',
                         help='Source folder with files to be processed.')
-    parser.add_argument('--num-processes', '-n', metavar='N', type=int,
+    def num_workers(value):
+        n = int(value)
+        if n < 1:
+            raise argparse.ArgumentTypeError('must be at least 1 (got %d)' % n)
+        return n
+
+    parser.add_argument('--num-processes', '-n', metavar='N', type=num_workers,
                         default=4, help='Number of multiprocess workers to '
-                                        'use. Default 4.')
+                                        'use for 48-spot (.dat) files. '
+                                        'Default 4.')
+    msg = ("Number of multiprocess workers to use for single-spot (.sm) "
+           "files. These workers run in parallel to the 48-spot workers. "
+           "Default 2.")
+    parser.add_argument('--num-light', metavar='N', type=num_workers, default=2,
+                        help=msg)
     msg = ("Notebook used for conversion to Photon-HDF5. If not specified, the "
            f"default is '{transfer.convert_notebook_name_inplace}'")
     parser.add_argument('--conversion-notebook', metavar='CONV_NB_NAME',
                         default=transfer.convert_notebook_name_inplace, help=msg)
+    msg = ("Notebook used for conversion of single-spot (.sm) files. If not "
+           f"specified, the default is '{transfer.convert_notebook_name_singlespot}'. "
+           "A single-spot notebook passed with --conversion-notebook "
+           "(deprecated) is also used for .sm files.")
+    parser.add_argument('--singlespot-notebook', metavar='CONV_NB_NAME',
+                        default=transfer.convert_notebook_name_singlespot,
+                        help=msg)
     parser.add_argument('--analyze', action='store_true',
                         help='Run smFRET analysis after files are converted.')
     msg = ("Notebook used for smFRET data analysis. If not specified, the "
@@ -125,6 +425,45 @@ if __name__ == '__main__':
                         help='Save a copy of the smFRET notebooks in HTML.')
     parser.add_argument('--keep-temp-files', action='store_true',
                         help='Do not delete files from temporary work folder.')
+    msg = ("Max bandwidth (MB/s) for copying from the acquisition folder "
+           "when no acquisition is running. Default no limit.")
+    parser.add_argument('--copy-rate', metavar='MBPS', type=float,
+                        default=None, help=msg)
+    msg = ("Max bandwidth (MB/s) for copying from the acquisition folder "
+           "while a data file is still being written (only with --monitor). "
+           "Default %.0f MB/s." %
+           (transfer.copy_rate_limits[transfer.remote_origin_basedir][1]
+            / transfer.MB))
+    parser.add_argument('--copy-rate-busy', metavar='MBPS', type=float,
+                        default=None, help=msg)
+    msg = ("Do not validate the YAML metadata and data files before "
+           "processing.")
+    parser.add_argument('--skip-preflight', action='store_true', help=msg)
+    msg = ("Copy data files to the temp folder before conversion: "
+           "'always', 'never' (convert in place reading the source) or "
+           "'auto' (decide for each file based on the measured source "
+           "throughput and the ramdisk free space). 'never' and 'auto' "
+           "require conversion notebooks accepting the `basedir` and "
+           "`out_basedir` arguments. While the copy rate is limited (see "
+           "--copy-rate and --copy-rate-busy), 'auto' copies the files to "
+           "the temp folder (if they fit), and in-place conversions wait "
+           "for the rate limit as if their reads were a copy. "
+           "Default 'always'.")
+    parser.add_argument('--staging', choices=('auto', 'always', 'never'),
+                        default='always', help=msg)
+    msg = ("Do not process any file. Predict the duration of the batch for "
+           "several numbers of workers and staging settings, using the "
+           "timings recorded in previous batches.")
+    parser.add_argument('--estimate', action='store_true', help=msg)
+    msg = "Do not show the progress bar."
+    parser.add_argument('--no-progress', action='store_true', help=msg)
+    msg = ("Periodically save the status (progress, throughput, ETA) "
+           "in this JSON file.")
+    parser.add_argument('--status-file', metavar='PATH', default=None,
+                        help=msg)
+    msg = "Serve the status as JSON on http://localhost:PORT/."
+    parser.add_argument('--status-port', metavar='PORT', type=int,
+                        default=None, help=msg)
     args = parser.parse_args()
 
     folder = Path(args.folder)
@@ -132,14 +471,61 @@ if __name__ == '__main__':
         sys.exit('\nFolder not found: %s\n' % folder)
     elif not folder.is_dir():
         sys.exit('\nYou must provide a folder (not a file) as an argument.\n')
+    idle_rate, busy_rate = transfer.copy_rate_limits[transfer.remote_origin_basedir]
+    if args.copy_rate is not None:
+        idle_rate = args.copy_rate * transfer.MB
+    if args.copy_rate_busy is not None:
+        busy_rate = args.copy_rate_busy * transfer.MB
+    transfer.copy_rate_limits[transfer.remote_origin_basedir] = (idle_rate, busy_rate)
+    conversion_notebook = args.conversion_notebook
+    if args.tempfile and conversion_notebook == transfer.convert_notebook_name_inplace:
+        conversion_notebook = transfer.convert_notebook_name_tempfile
+    if ' SM' in conversion_notebook and \
+            args.singlespot_notebook not in (
+                transfer.convert_notebook_name_singlespot, conversion_notebook):
+        sys.exit('\nPass the single-spot notebook only with '
+                 '--singlespot-notebook (not --conversion-notebook).\n')
     analyze_kws = dict(input_notebook=args.notebook, save_html=args.save_html,
                        working_dir=args.working_dir)
     kwargs = dict(dry_run=args.dry_run, nproc=args.num_processes,
-                  conversion_notebook=args.conversion_notebook,
+                  nproc_light=args.num_light,
+                  conversion_notebook=conversion_notebook,
+                  singlespot_notebook=args.singlespot_notebook,
                   analyze=args.analyze, analyze_kws=analyze_kws,
-                  remove=not args.keep_temp_files)
-    if args.monitor:
-        start_monitoring(folder, **kwargs)
-    else:
-        batch_process(folder, **kwargs)
-    print('Monitor execution end.', flush=True)
+                  remove=not args.keep_temp_files,
+                  check_metadata=not args.skip_preflight,
+                  staging_mode=args.staging)
+    if args.estimate:
+        log_queue, listener = joblog.start_logging()
+        try:
+            estimate(folder, nproc=args.num_processes,
+                     nproc_light=args.num_light, analyze=args.analyze,
+                     remove=not args.keep_temp_files)
+        finally:
+            listener.stop()
+        sys.exit()
+
+    # Heavy and light jobs run in separate pools: ETA computed for each pool
+    tracker = status.StatusTracker(nproc=dict(heavy=args.num_processes,
+                                              light=args.num_light),
+                                   resource_classes=resource_classes,
+                                   status_file=args.status_file,
+                                   port=args.status_port,
+                                   progress=not args.no_progress)
+    handlers = [tracker]
+    if not args.dry_run:
+        # Stage timings of real runs are used by --estimate
+        handlers.append(capacity.TimingRecorder())
+    log_queue, listener = joblog.start_logging(handlers=handlers)
+    tracker.start()
+    try:
+        if args.monitor:
+            start_monitoring(folder, **kwargs)
+        else:
+            batch_process(folder, **kwargs)
+        log.info('Monitor execution end.')
+    finally:
+        listener.stop()
+        tracker.stop()
+        for handler in handlers:
+            handler.close()
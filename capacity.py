@@ -0,0 +1,434 @@
+"""
+Capacity planning: predict the duration of a batch from recorded timings.
+
+During real (not dry-run) batches, `TimingRecorder` saves the duration of
+each processing stage (copy, convert, archive, remove, analyze) together
+with the file size and type in a CSV history file. From this history,
+`CostModel` estimates the cost of each stage as `a + b * nbytes`.
+
+`simulate()` runs a discrete-event simulation of a batch: jobs hold a pool
+worker for their whole duration, staged files hold space on the ramdisk
+until they are archived, and all the reads from the acquisition share
+(copy to ramdisk, or in-place conversion and archive copy) go through one
+shared link. `estimate()` simulates several configurations and reports the
+predicted makespan and the bottleneck, without touching any data.
+"""
+
+import os
+import csv
+import time
+import heapq
+import logging
+from pathlib import Path
+from collections import deque, defaultdict
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # File locking not available on Windows
+
+from ratelimit import MB
+
+
+log = logging.getLogger(__name__)
+
+history_fname = Path.home() / '.transfer_convert' / 'stage_timings.csv'
+history_fields = ('date', 'stage', 'kind', 'nbytes', 'duration', 'concurrency')
+
+# Stages sharing the bandwidth of the acquisition share. Their recorded
+# durations are scaled by the number of concurrent copies.
+shared_stages = ('copy',)
+
+# Stage costs (a, b) used when there is no history: duration = a + b * nbytes
+default_stage_costs = {
+    'copy': (0.5, 1 / (100 * MB)),
+    'convert': (10, 1 / (50 * MB)),
+    'archive': (1, 1 / (200 * MB)),
+    'remove': (6, 0),
+    'analyze': (60, 1 / (20 * MB)),
+}
+
+# Ramdisk space used by the outputs of a conversion (Photon-HDF5 file and
+# notebook), as multiple of the data file size. A staged file also uses
+# the space of the data file copy.
+output_usage_factor = 1
+
+
+class TimingRecorder(logging.Handler):
+    """Log handler saving the stage timings reported by `status.stage()`.
+
+    Rows are buffered and appended to `fname` every `flush_rows` rows
+    and when the handler is closed.
+    """
+    def __init__(self, fname=None, flush_rows=20):
+        super().__init__(level=logging.DEBUG)
+        self.fname = Path(history_fname if fname is None else fname)
+        self.flush_rows = flush_rows
+        self._rows = []
+        self._running = defaultdict(set)     # {stage: set of jobs}
+
+    def emit(self, record):
+        event = getattr(record, 'status_event', None)
+        if event == 'stage_start':
+            self._running[record.status_stage].add(record.job)
+        elif event in ('stage_end', 'stage_failed'):
+            running = self._running[record.status_stage]
+            concurrency = max(1, len(running))
+            running.discard(record.job)
+            if event == 'stage_end':
+                self._rows.append((time.strftime('%Y-%m-%d %H:%M:%S'),
+                                   record.status_stage, record.status_kind,
+                                   record.status_nbytes,
+                                   '%.3f' % record.status_duration,
+                                   concurrency))
+                if len(self._rows) >= self.flush_rows:
+                    self.flush()
+
+    def flush(self):
+        if len(self._rows) == 0:
+            return
+        self.fname.parent.mkdir(parents=True, exist_ok=True)
+        with open(str(self.fname), 'a', newline='') as f:
+            # The history file is shared by concurrent batches
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0, os.SEEK_END)
+                writer = csv.writer(f)
+                if f.tell() == 0:
+                    writer.writerow(history_fields)
+                writer.writerows(self._rows)
+                f.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        self._rows = []
+
+    def close(self):
+        self.flush()
+        super().close()
+
+
+def load_history(fname=None):
+    """Load the stage timings history. Returns a list of dicts."""
+    fname = Path(history_fname if fname is None else fname)
+    if not fname.is_file():
+        return []
+    with open(str(fname), newline='') as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        row['nbytes'] = int(row['nbytes'])
+        row['duration'] = float(row['duration'])
+        row['concurrency'] = int(row['concurrency'])
+    return rows
+
+
+def fit_cost(sizes, durations):
+    """Least-squares fit of `durations = a + b * sizes`, with a, b >= 0."""
+    n = len(sizes)
+    mean_size, mean_duration = sum(sizes) / n, sum(durations) / n
+    var_size = sum((s - mean_size)**2 for s in sizes)
+    if var_size == 0:
+        # All files of the same size: cost proportional to the size
+        if mean_size == 0:
+            return mean_duration, 0
+        return 0, mean_duration / mean_size
+    b = sum((s - mean_size) * (d - mean_duration)
+            for s, d in zip(sizes, durations)) / var_size
+    b = max(0, b)
+    a = max(0, mean_duration - b * mean_size)
+    return a, b
+
+
+class CostModel:
+    """Cost (seconds) of each stage as a function of file type and size.
+
+    Costs are fitted for each (stage, file type) from the history. When
+    a file type has no history, the fit for all the file types is used.
+    When a stage has no history, `default_stage_costs` is used.
+    """
+    def __init__(self, history=None):
+        if history is None:
+            history = load_history()
+        groups = defaultdict(list)
+        for row in history:
+            duration = row['duration']
+            if row['stage'] in shared_stages:
+                duration /= row['concurrency']
+            groups[row['stage'], row['kind']].append((row['nbytes'], duration))
+            groups[row['stage'], None].append((row['nbytes'], duration))
+        self.costs = {key: fit_cost(*zip(*values))
+                      for key, values in groups.items()}
+        self.num_rows = len(history)
+
+    def cost_params(self, stage, kind=None):
+        for key in ((stage, kind), (stage, None)):
+            if key in self.costs:
+                return self.costs[key]
+        return default_stage_costs[stage]
+
+    def cost(self, stage, nbytes, kind=None):
+        a, b = self.cost_params(stage, kind)
+        return a + b * nbytes
+
+    def link_rate(self, kind=None):
+        """Throughput (bytes/s) of the link to the acquisition share."""
+        a, b = self.cost_params('copy', kind)
+        return 1 / b if b > 0 else float('inf')
+
+
+class Resource:
+    """Simulated resource with a capacity, served in FIFO order."""
+    def __init__(self, sim, name, capacity):
+        self.sim = sim
+        self.name = name
+        self.capacity = capacity
+        self.level = 0
+        self.waiting = deque()
+        self.busy_area = 0
+        self.wait_time = 0
+        self._last_time = 0
+
+    def _update_area(self):
+        self.busy_area += self.level * (self.sim.now - self._last_time)
+        self._last_time = self.sim.now
+
+    def acquire(self, proc, amount):
+        amount = min(amount, self.capacity)
+        if len(self.waiting) == 0 and self.level + amount <= self.capacity:
+            self._update_area()
+            self.level += amount
+            self.sim.schedule(proc)
+        else:
+            self.waiting.append((proc, amount, self.sim.now))
+
+    def release(self, amount):
+        amount = min(amount, self.capacity)
+        self._update_area()
+        self.level -= amount
+        while self.waiting and self.level + self.waiting[0][1] <= self.capacity:
+            proc, amount, t_request = self.waiting.popleft()
+            self.level += amount
+            self.wait_time += self.sim.now - t_request
+            self.sim.schedule(proc)
+
+    def utilization(self):
+        self._update_area()
+        if self.sim.now == 0 or self.capacity in (0, float('inf')):
+            return 0
+        return self.busy_area / (self.capacity * self.sim.now)
+
+
+class Simulator:
+    """Minimal discrete-event simulator driving generator "processes".
+
+    A process yields requests: ('delay', seconds), ('acquire', resource,
+    amount) or ('release', resource, amount).
+    """
+    def __init__(self):
+        self.now = 0
+        self._queue = []
+        self._seq = 0
+
+    def schedule(self, proc, delay=0):
+        heapq.heappush(self._queue, (self.now + delay, self._seq, proc))
+        self._seq += 1
+
+    def _step(self, proc):
+        try:
+            request = next(proc)
+        except StopIteration:
+            return
+        if request[0] == 'delay':
+            self.schedule(proc, request[1])
+        elif request[0] == 'acquire':
+            request[1].acquire(proc, request[2])
+        elif request[0] == 'release':
+            request[1].release(request[2])
+            self.schedule(proc)
+
+    def run(self):
+        while self._queue:
+            self.now, _, proc = heapq.heappop(self._queue)
+            self._step(proc)
+        return self.now
+
+
+def convert_job(fname, size, model, workers, link, ramdisk, stage_times,
+                staged=True, remove=True, analyze=False):
+    """Simulated process of `transfer.process()` for one data file."""
+    kind = fname.suffix
+    # Temp files stay on the ramdisk until they are removed (never,
+    # without `remove`): in place, only the outputs are written there
+    ramdisk_usage = size * (output_usage_factor + (1 if staged else 0))
+    yield ('acquire', workers, 1)
+    start = workers.sim.now
+    yield ('acquire', ramdisk, ramdisk_usage)
+    if staged:
+        yield ('acquire', link, 1)
+        yield ('delay', model.cost('copy', size, kind))
+        yield ('release', link, 1)
+        stage_times['copy'] += workers.sim.now - start
+        start = workers.sim.now
+        yield ('delay', model.cost('convert', size, kind))
+    else:
+        # The conversion reads the data from the share
+        read_time = size / model.link_rate(kind)
+        yield ('acquire', link, 1)
+        yield ('delay', read_time)
+        yield ('release', link, 1)
+        yield ('delay', max(0, model.cost('convert', size, kind) - read_time))
+    stage_times['convert'] += workers.sim.now - start
+    start = workers.sim.now
+    if not staged:
+        # The archive copy reads the data file from the share again
+        yield ('acquire', link, 1)
+        yield ('delay', size / model.link_rate(kind))
+        yield ('release', link, 1)
+    yield ('delay', model.cost('archive', size, kind))
+    stage_times['archive'] += workers.sim.now - start
+    if remove:
+        start = workers.sim.now
+        yield ('delay', model.cost('remove', size, kind))
+        yield ('release', ramdisk, ramdisk_usage)
+        stage_times['remove'] += workers.sim.now - start
+    if analyze:
+        start = workers.sim.now
+        yield ('delay', model.cost('analyze', size, kind))
+        stage_times['analyze'] += workers.sim.now - start
+    yield ('release', workers, 1)
+
+
+def analysis_job(fname, size, model, workers, stage_times):
+    """Simulated process of `batch_analyze.analyze_file()`."""
+    yield ('acquire', workers, 1)
+    start = workers.sim.now
+    yield ('delay', model.cost('analyze', size, fname.suffix))
+    stage_times['analyze'] += workers.sim.now - start
+    yield ('release', workers, 1)
+
+
+def simulate(files, model, nprocs, resource_classes=None, staged=True,
+             remove=True, analyze=False, ramdisk_size=float('inf')):
+    """Simulate a batch and return a dict with the results.
+
+    Arguments:
+        files (list): list of (path, size) of the files to be processed.
+        model (CostModel): cost of each stage.
+        nprocs (dict): number of workers for each resource class.
+        resource_classes (dict or None): resource class of each file type
+            (extension). If None, files are analyzed (`batch_analyze`)
+            using the workers of the first class in `nprocs`, otherwise
+            they are converted (`batch_convert`).
+        staged (bool): whether files are copied to the ramdisk.
+        ramdisk_size (float): capacity of the ramdisk in bytes.
+
+    Raises:
+        ValueError: if some files can never be processed (e.g. there are
+            no workers for their resource class).
+    """
+    sim = Simulator()
+    workers = {res_class: Resource(sim, 'workers (%s)' % res_class, n)
+               for res_class, n in nprocs.items()}
+    link = Resource(sim, 'link to acquisition share', 1)
+    ramdisk = Resource(sim, 'ramdisk space', ramdisk_size)
+    stage_times = defaultdict(float)
+    no_workers = defaultdict(int)
+    for fname, size in files:
+        res_class = (next(iter(nprocs), None) if resource_classes is None
+                     else resource_classes[fname.suffix])
+        pool = workers.get(res_class)
+        if pool is None or pool.capacity < 1:
+            no_workers[res_class] += 1
+            continue
+        if resource_classes is None:
+            proc = analysis_job(fname, size, model, pool, stage_times)
+        else:
+            proc = convert_job(fname, size, model, pool, link, ramdisk,
+                               stage_times, staged=staged, remove=remove,
+                               analyze=analyze)
+        sim.schedule(proc)
+    if len(no_workers) > 0:
+        raise ValueError('no workers for %s' % ', '.join(
+            '%d file(s) of class %s' % (n, res_class)
+            for res_class, n in no_workers.items()))
+    makespan = sim.run()
+    resources = list(workers.values())
+    if resource_classes is not None:
+        resources += [link, ramdisk]
+    waiting = ['%d job(s) waiting forever for %s' % (len(res.waiting), res.name)
+               for res in resources if len(res.waiting) > 0]
+    if len(waiting) > 0:
+        raise ValueError(', '.join(waiting))
+    utilization = {res.name: res.utilization() for res in resources}
+    wait_time = {res.name: res.wait_time for res in resources}
+    bottleneck = max(utilization, key=utilization.get)
+    return dict(makespan=makespan, utilization=utilization,
+                wait_time=wait_time, stage_times=dict(stage_times),
+                bottleneck=bottleneck)
+
+
+def format_duration(seconds):
+    return time.strftime('%H:%M:%S', time.gmtime(seconds)) + (
+        ' (+%dd)' % (seconds // 86400) if seconds >= 86400 else '')
+
+
+def estimate(files, configs, model=None, **kwargs):
+    """Simulate several configurations and log a report.
+
+    Arguments:
+        files (list of Path): files to be processed.
+        configs (list of dict): each dict contains arguments for
+            `simulate()` (e.g. `nprocs` and `staged`) and is reported
+            in the table.
+        kwargs: additional arguments passed to `simulate()` for all the
+            configurations.
+
+    Returns:
+        List of (config, result) tuples. `result` is None for the
+        configurations which cannot process all the files.
+    """
+    if model is None:
+        model = CostModel()
+    files = [(Path(f), Path(f).stat().st_size) for f in files]
+    kinds = defaultdict(int)
+    for f, size in files:
+        kinds[f.suffix] += 1
+    lines = ['Estimate for %d files (%.1f GB): %s' %
+             (len(files), sum(size for f, size in files) / 1024**3,
+              ', '.join('%d x %s' % (n, kind) for kind, n in kinds.items())),
+             '  Cost model from %d recorded stage timings%s.' %
+             (model.num_rows, '' if model.num_rows else
+              ' (using default costs)')]
+    results, labels, errors = [], [], []
+    for config in configs:
+        try:
+            res, error = simulate(files, model, **config, **kwargs), None
+        except ValueError as e:
+            res, error = None, str(e)
+        results.append((config, res))
+        errors.append(error)
+        labels.append(', '.join(
+            '%s=%s' % (k, ('/'.join('%s:%d' % item for item in v.items())
+                           if isinstance(v, dict) else v))
+            for k, v in config.items()))
+    width = max(len(label) for label in labels + ['configuration'])
+    lines.append('  %-*s  %-10s %s' % (width, 'configuration', 'makespan',
+                                       'bottleneck'))
+    for label, (config, res), error in zip(labels, results, errors):
+        if res is None:
+            lines.append('  %-*s  %-10s %s' % (width, label, 'never',
+                                               error))
+            continue
+        lines.append('  %-*s  %-10s %s (%.0f%% busy)' %
+                     (width, label, format_duration(res['makespan']),
+                      res['bottleneck'],
+                      100 * res['utilization'][res['bottleneck']]))
+    feasible = [item for item in results if item[1] is not None]
+    if len(feasible) > 0:
+        best_config, best = min(feasible, key=lambda item: item[1]['makespan'])
+        stage_times = ', '.join('%s %s' % (stage, format_duration(t))
+                                for stage, t in best['stage_times'].items())
+        lines.append('  Best configuration, total time per stage: ' +
+                     stage_times)
+    log.info('\n'.join(lines))
+    return results
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Check that importing the scripts does not load the Jupyter/IPython stack.
+
+Each module is imported in a fresh interpreter. The script fails when a
+module imports one of the `heavy_modules` or when its import time exceeds
+`max_import_time`. Run it after changing the imports of any module.
+"""
+
+import sys
+import json
+import subprocess as sp
+from pathlib import Path
+
+
+entry_modules = ['nbrun', 'analyze', 'transfer', 'batch_convert',
+                 'batch_analyze']
+heavy_modules = ['IPython', 'nbformat', 'nbconvert', 'jupyter_client', 'zmq',
+                 'pandas', 'numpy']
+max_import_time = 0.15   # seconds
+
+
+def import_time(module, repeat=5):
+    """Return (min import time, list of imported modules) for `module`."""
+    code = ('import sys, time, json\n'
+            't = time.perf_counter()\n'
+            f'import {module}\n'
+            't = time.perf_counter() - t\n'
+            'print(json.dumps([t, sorted(sys.modules)]))')
+    times = []
+    for i in range(repeat):
+        out = sp.check_output([sys.executable, '-c', code],
+                              cwd=str(Path(__file__).parent))
+        t, modules = json.loads(out)
+        times.append(t)
+    return min(times), modules
+
+
+def check_import_time(modules=None, repeat=5):
+    """Check all the `modules`. Return the list of errors."""
+    if modules is None:
+        modules = entry_modules
+    errors = []
+    for module in modules:
+        t, imported = import_time(module, repeat=repeat)
+        heavy = sorted(m for m in heavy_modules if m in imported)
+        print('  %-15s %6.1f ms %s' % (module, t * 1e3,
+              'imports: ' + ', '.join(heavy) if heavy else ''), flush=True)
+        if heavy:
+            errors.append(f'{module} imports {", ".join(heavy)}')
+        if t > max_import_time:
+            errors.append(f'{module} import takes {t * 1e3:.0f} ms '
+                          f'(max {max_import_time * 1e3:.0f} ms)')
+    return errors
+
+
+if __name__ == '__main__':
+    print('Import time (min of 5 runs):')
+    errors = check_import_time()
+    if errors:
+        sys.exit('\nImport time check FAILED:\n  ' + '\n  '.join(errors))
+    print('\nImport time check passed.')
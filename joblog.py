@@ -0,0 +1,160 @@
+"""
+Non-blocking logging for multiprocess batches.
+
+All the processes (parent and pool workers) send their log records to a
+single queue. A listener in the parent process is the only one writing
+to the terminal and to the log files, so the workers never block on
+terminal I/O and their output is not interleaved.
+
+Records logged while processing a file (see `job()`) are also written to
+a buffered log file for that file, so that the history of each file can
+be read on its own. The console shows a compact view (level INFO and
+above, one line per record, prefixed by the job name).
+
+Usage:
+
+    log_queue, listener = joblog.start_logging()
+    with Pool(initializer=joblog.init_worker, initargs=(log_queue,)) as pool:
+        ...
+    listener.stop()
+"""
+
+import sys
+import logging
+import logging.handlers
+import multiprocessing as mp
+from contextlib import contextmanager
+from pathlib import Path
+
+
+console_format = '%(asctime)s %(job)-20.20s %(message)s'
+file_format = '%(asctime)s %(levelname)-7s %(processName)s: %(message)s'
+date_format = '%H:%M:%S'
+file_buffer_size = 64 * 1024
+
+# Queue of the log listener started by `start_logging()` in this process
+log_queue = None
+
+# Job of the current process: (name, log file) or None
+_current_job = None
+
+
+class JobFilter(logging.Filter):
+    """Add the current job name and log file to each record."""
+    def filter(self, record):
+        name, logfile = _current_job if _current_job is not None else ('', None)
+        if not hasattr(record, 'job'):
+            record.job = name
+        if not hasattr(record, 'logfile'):
+            record.logfile = None if logfile is None else str(logfile)
+        return True
+
+
+class JobFileHandler(logging.Handler):
+    """Write records to the log file of their job.
+
+    Files are opened in append mode with a large buffer and are flushed
+    only when the job ends (record with `job_end=True`) or on close.
+    """
+    def __init__(self, level=logging.DEBUG):
+        super().__init__(level=level)
+        self.setFormatter(logging.Formatter(file_format))
+        self._files = {}
+
+    def emit(self, record):
+        logfile = getattr(record, 'logfile', None)
+        if logfile is None:
+            return
+        try:
+            f = self._files.get(logfile)
+            if f is None:
+                Path(logfile).parent.mkdir(parents=True, exist_ok=True)
+                f = open(logfile, 'a', buffering=file_buffer_size)
+                self._files[logfile] = f
+            f.write(self.format(record) + '\n')
+            if getattr(record, 'job_end', False):
+                self._files.pop(logfile).close()
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        super().close()
+
+
+class ConsoleHandler(logging.StreamHandler):
+    """Stream handler which does not break a tqdm progress bar."""
+    def emit(self, record):
+        if 'tqdm' not in sys.modules:
+            return super().emit(record)
+        from tqdm import tqdm
+        try:
+            tqdm.write(self.format(record), file=self.stream)
+        except Exception:
+            self.handleError(record)
+
+
+def make_console_handler(level=logging.INFO, stream=None):
+    handler = ConsoleHandler(sys.stdout if stream is None else stream)
+    handler.setLevel(level)
+    handler.setFormatter(logging.Formatter(console_format, date_format))
+    return handler
+
+
+def init_worker(queue, level=logging.DEBUG):
+    """Send all the log records of the current process to `queue`.
+
+    Used as (or called by) the initializer of the pool workers.
+    If `queue` is None, logging is not changed.
+    """
+    if queue is None:
+        return
+    handler = logging.handlers.QueueHandler(queue)
+    handler.addFilter(JobFilter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+
+def start_logging(console_level=logging.INFO, handlers=()):
+    """Start the log listener and send the records of this process to it.
+
+    Arguments:
+        console_level (int): min level of records shown in the console.
+        handlers (sequence): additional handlers for the listener.
+
+    Returns:
+        A tuple (log_queue, listener). Pass `log_queue` to `init_worker()`
+        in each worker process and call `listener.stop()` at the end to
+        flush and close all the log files.
+    """
+    global log_queue
+    log_queue = mp.Queue()
+    listener = logging.handlers.QueueListener(
+        log_queue, make_console_handler(console_level), JobFileHandler(),
+        *handlers, respect_handler_level=True)
+    listener.start()
+    init_worker(log_queue)
+    return log_queue, listener
+
+
+@contextmanager
+def job(name, logfile):
+    """Context manager assigning the records logged inside to a job.
+
+    Records are written to `logfile` (in addition to the console).
+    Nested calls are ignored: records go to the outermost job.
+    """
+    global _current_job
+    if _current_job is not None:
+        yield
+        return
+    _current_job = (name, logfile)
+    try:
+        yield
+    finally:
+        logging.getLogger(__name__).debug('Log closed.',
+                                          extra=dict(job_end=True))
+        _current_job = None
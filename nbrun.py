@@ -9,17 +9,37 @@ USAGE
 Copy this file in the folder containing the master notebook used to
 execute the other notebooks. Then use `run_notebook()` to execute
 notebooks.
+
+RESULTS
+-------
+
+Executed notebooks can emit named results calling `emit_result()`, e.g.
+`emit_result(num_bursts=1234, E_peak=0.52)`. When `run_notebook()` is
+called with a `results_path`, the results are collected from the executed
+notebook and appended to a CSV file (one row per result). Use
+`load_results()` to load the results in a table without re-executing
+any notebook.
 """
 
+import os
+import csv
+import json
 import time
 from pathlib import Path
-from IPython.display import display, FileLink
-import nbformat
-from nbconvert.preprocessors import ExecutePreprocessor
-from nbconvert import HTMLExporter
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # File locking not available on Windows
+
+# IPython, nbformat and nbconvert are imported only when a notebook is
+# executed, so that importing this module (e.g. in the scripts using it,
+# or in the worker processes) is fast. See `check_import_time.py`.
 
 __version__ = '0.2'
 
+result_mimetype = 'application/x-nbrun-result+json'
+results_fields = ('key', 'executed', 'notebook', 'name', 'value')
+
 
 def dict_to_code(mapping):
     """Convert input dict `mapping` to a string containing python code.
@@ -43,13 +63,92 @@ def dict_to_code(mapping):
     return '\n'.join(lines)
 
 
+def emit_result(**results):
+    """Emit named results from a notebook executed by `run_notebook()`.
+
+    Call this function in the notebook, passing the results as keyword
+    arguments. Values can be numbers, strings, lists or numpy arrays.
+    The results are stored in the notebook output and collected by
+    `run_notebook()` (see `results_path` argument).
+    """
+    from IPython.display import display
+    results = {name: value.tolist() if hasattr(value, 'tolist') else value
+               for name, value in results.items()}
+    display({result_mimetype: results}, raw=True)
+
+
+def collect_results(nb):
+    """Return a dict of results emitted by `emit_result()` in notebook `nb`.
+
+    If a result is emitted more than once, the last value is returned.
+    """
+    results = {}
+    for cell in nb['cells']:
+        for output in cell.get('outputs', []):
+            if result_mimetype in output.get('data', {}):
+                results.update(output['data'][result_mimetype])
+    return results
+
+
+def append_results(results_path, results, key, notebook='', executed=''):
+    """Append `results` (a dict) to the CSV file `results_path`.
+
+    Each result is saved in one row with columns `results_fields`. Values
+    are saved as JSON. The file is locked during the write, so multiple
+    processes can append to the same file.
+    """
+    if len(results) == 0:
+        return
+    rows = [(key, executed, notebook, name, json.dumps(value))
+            for name, value in results.items()]
+    with open(str(results_path), 'a', newline='') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            # Another process may have written since the file was opened
+            f.seek(0, os.SEEK_END)
+            writer = csv.writer(f)
+            if f.tell() == 0:
+                writer.writerow(results_fields)
+            writer.writerows(rows)
+            f.flush()
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load_results(results_path, latest=True):
+    """Load results saved by `run_notebook()` in a pandas DataFrame.
+
+    Returns a DataFrame with one row for each key (usually a data file)
+    and one column for each result name.
+
+    Arguments:
+        results_path (pathlib.Path or string): CSV file with the results.
+        latest (bool): if True (default) when a notebook was executed more
+            than once for the same key, use the results of the last
+            execution. If False, return the "long" table with all the rows
+            saved in the file (columns `results_fields`).
+    """
+    import pandas as pd
+    with open(str(results_path), newline='') as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        row['value'] = json.loads(row['value'])
+    table = pd.DataFrame(rows, columns=results_fields)
+    if not latest:
+        return table
+    table = table.drop_duplicates(subset=['key', 'name'], keep='last')
+    return table.pivot(index='key', columns='name', values='value')
+
+
 def run_notebook(notebook_path, nb_kwargs=None, suffix='-out',
                  out_path_ipynb=None, out_path_html=None,
                  kernel_name=None, working_dir='./',
                  timeout=3600, execute_kwargs=None,
                  save_ipynb=True, save_html=False,
                  insert_pos=1, hide_input=False, display_links=True,
-                 return_nb=False):
+                 return_nb=False, results_path=None, results_key=None):
     """Runs a notebook and saves the output in a new notebook.
 
     Executes a notebook, optionally passing "arguments"
@@ -107,7 +206,19 @@ def run_notebook(notebook_path, nb_kwargs=None, suffix='-out',
             In a text terminal, links are displayed as full file names.
         return_nb (bool): if True, returns the notebook object. If False
             returns None. Default False.
+        results_path (pathlib.Path, string or None): if not None, results
+            emitted in the notebook by `emit_result()` are appended to this
+            CSV file (see `append_results()`). Results are saved only
+            if the notebook execution succeeds.
+        results_key (string or None): key identifying the results of this
+            execution in `results_path`. If None, use the output notebook
+            file name.
     """
+    from IPython.display import display, FileLink
+    import nbformat
+    from nbconvert.preprocessors import ExecutePreprocessor
+    from nbconvert import HTMLExporter
+
     timestamp_cell = ("**Executed:** %s\n\n**Duration:** %d seconds.\n\n"
                       "**Autogenerated from:** [%s](%s)")
     if nb_kwargs is None:
@@ -158,6 +269,7 @@ def run_notebook(notebook_path, nb_kwargs=None, suffix='-out',
         ep.preprocess(nb, {'metadata': {'path': working_dir}})
     except:
         # Execution failed, print a message then raise.
+        results_path = None
         msg = ('Error executing the notebook "%s".\n'
                'Notebook arguments: %s\n\n'
                'See notebook "%s" for the traceback.' %
@@ -176,6 +288,12 @@ def run_notebook(notebook_path, nb_kwargs=None, suffix='-out',
             nbformat.write(nb, str(out_path_ipynb))
             if display_links:
                 display(FileLink(str(out_path_ipynb)))
+        if results_path is not None:
+            if results_key is None:
+                results_key = str(out_path_ipynb)
+            append_results(results_path, collect_results(nb), key=results_key,
+                           notebook=str(notebook_path),
+                           executed=time.ctime(start_time))
         if save_html:
             html_exporter = HTMLExporter()
             body, resources = html_exporter.from_notebook_node(nb)
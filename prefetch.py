@@ -0,0 +1,122 @@
+"""
+Read-ahead of the data files queued for analysis.
+
+The `Prefetcher` thread runs in the parent process and reads the next files
+in the queue while the pool workers are busy analyzing the current ones.
+Once read, the files are in the OS page cache and the analysis notebooks do
+not wait for the (slow) archive disk. The total size of files read ahead
+and not yet analyzed is kept within a memory budget.
+"""
+
+import os
+import logging
+import threading
+from pathlib import Path
+
+from ratelimit import MB
+
+
+log = logging.getLogger(__name__)
+
+
+def get_available_memory():
+    """Return the available memory in bytes (None if unknown)."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+
+def warm_file(path, stop_event=None, chunk_size=4 * MB):
+    """Read the whole file sequentially to load it in the page cache.
+
+    Returns:
+        Number of bytes read.
+    """
+    buffer = bytearray(chunk_size)
+    nread = 0
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        while stop_event is None or not stop_event.is_set():
+            size = f.readinto(buffer)
+            if size == 0:
+                break
+            nread += size
+    return nread
+
+
+class Prefetcher(threading.Thread):
+    """Thread warming the page cache for the next files in the queue.
+
+    Files are assumed to be processed in the order of `filelist`.
+    The first `skip` files (the ones started immediately by the pool)
+    are not prefetched.
+
+    Arguments:
+        filelist (list of Path): ordered queue of files to be processed.
+        skip (int): number of files started before the first completes,
+            usually the number of pool workers.
+        depth (int): number of queued files to be read ahead.
+        mem_budget (int or None): max total size (bytes) of the files
+            read ahead and not yet completed. If None, use half of the
+            currently available memory.
+    """
+    def __init__(self, filelist, skip=4, depth=2, mem_budget=None):
+        super().__init__(daemon=True)
+        self.filelist = [Path(f) for f in filelist]
+        self.skip = skip
+        self.depth = depth
+        if mem_budget is None:
+            mem_available = get_available_memory()
+            mem_budget = 4096 * MB if mem_available is None else mem_available // 2
+        self.mem_budget = mem_budget
+        self._num_done = 0
+        self._warmed = {}
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+
+    def done(self, fname):
+        """Notify that processing of `fname` is completed."""
+        with self._cond:
+            self._num_done += 1
+            self._warmed.pop(Path(fname), None)
+            self._cond.notify()
+
+    def stop(self):
+        self._stop_event.set()
+        with self._cond:
+            self._cond.notify()
+
+    def _next_file(self):
+        # Must be called with the lock held. Returns the next file to be
+        # read ahead or None if there is nothing to do now.
+        start = self._num_done + self.skip
+        for fname in self.filelist[start:start + self.depth]:
+            if fname in self._warmed:
+                continue
+            size = fname.stat().st_size
+            if size > self.mem_budget:
+                # Never fits in the budget, do not prefetch it
+                self._warmed[fname] = 0
+                continue
+            if sum(self._warmed.values()) + size > self.mem_budget:
+                return None
+            self._warmed[fname] = size
+            return fname
+
+    def run(self):
+        while not self._stop_event.is_set():
+            with self._cond:
+                fname = self._next_file()
+                if fname is None:
+                    if self._num_done >= len(self.filelist):
+                        return
+                    self._cond.wait()
+                    continue
+            nbytes = warm_file(fname, stop_event=self._stop_event)
+            log.debug('- Prefetched %s (%.1f MB)', fname.name, nbytes / MB)
@@ -0,0 +1,149 @@
+"""
+Pre-flight validation of data files and YAML metadata before conversion.
+
+Each data file must have a YAML metadata file with the same name
+(extension .yml). Here we check that the YAML file can be parsed, that it
+contains the fields required by the conversion notebooks and that the data
+file looks sane (non-empty, consistent size and header). The metadata has no
+field describing the data file, so the two files are checked independently.
+Files are checked in parallel, so that malformed files can be rejected before
+any data is copied to the temp folder or a kernel is started.
+"""
+
+import struct
+import logging
+from pathlib import Path
+from multiprocessing import Pool
+
+import yaml
+
+
+log = logging.getLogger(__name__)
+
+
+# Required fields in the YAML metadata: {field: type}, nested dicts
+# describe sub-groups. Edit this dict to change the validation rules.
+metadata_schema = {
+    'description': str,
+    'sample': {
+        'sample_name': str,
+        'dye_names': str,
+        'buffer_name': str,
+    },
+    'identity': {
+        'author': str,
+        'author_affiliation': str,
+    },
+}
+
+
+def check_schema(metadata, schema=None, prefix=''):
+    """Check a metadata dict against `schema`. Return a list of errors."""
+    if schema is None:
+        schema = metadata_schema
+    errors = []
+    for key, value_type in schema.items():
+        name = prefix + key
+        if key not in metadata or metadata[key] is None:
+            errors.append(f"missing field '{name}'")
+        elif isinstance(value_type, dict):
+            if not isinstance(metadata[key], dict):
+                errors.append(f"field '{name}' must be a group of fields")
+            else:
+                errors += check_schema(metadata[key], value_type,
+                                       prefix=name + '/')
+        elif not isinstance(metadata[key], value_type):
+            errors.append(f"field '{name}' must be of type "
+                          f"{value_type.__name__} (got "
+                          f"{type(metadata[key]).__name__})")
+    return errors
+
+
+def check_data_file(datafile):
+    """Check size and header of the data file. Return a list of errors.
+
+    The file is checked on its own: the metadata does not contain any field
+    (e.g. number of spots or acquisition duration) implying a size or header.
+    """
+    size = datafile.stat().st_size
+    if size == 0:
+        return ['data file is empty']
+    errors = []
+    if datafile.suffix == '.dat':
+        # 48-spot data is a stream of 32-bit words
+        if size % 4 != 0:
+            errors.append(f'data file size ({size} bytes) is not a '
+                          'multiple of 4 bytes (truncated file?)')
+    elif datafile.suffix == '.sm':
+        # us-ALEX SM files start with a big-endian int32 with the
+        # offset of the photon data, i.e. the header length
+        with open(datafile, 'rb') as f:
+            header = f.read(4)
+        if len(header) < 4:
+            errors.append('data file is shorter than the SM header')
+        else:
+            offset = struct.unpack('>i', header)[0]
+            if not 4 <= offset < size:
+                errors.append(f'invalid SM header length ({offset} bytes, '
+                              f'file size {size} bytes)')
+    return errors
+
+
+def validate(datafile):
+    """Validate a data file and its YAML metadata.
+
+    Returns:
+        A tuple (datafile, errors) where `errors` is a list of strings
+        (empty when the file is valid).
+    """
+    datafile = Path(datafile)
+    meta_fname = datafile.with_suffix('.yml')
+    errors = []
+    try:
+        with open(meta_fname) as f:
+            metadata = yaml.safe_load(f)
+    except FileNotFoundError:
+        errors.append(f'metadata file not found: {meta_fname.name}')
+    except yaml.YAMLError as e:
+        msg = ' '.join(str(e).split())
+        errors.append(f'invalid YAML in {meta_fname.name}: {msg}')
+    else:
+        if not isinstance(metadata, dict):
+            errors.append(f'metadata file {meta_fname.name} does not '
+                          'contain a dictionary')
+        else:
+            errors += check_schema(metadata)
+    try:
+        errors += check_data_file(datafile)
+    except OSError as e:
+        errors.append(f'cannot read data file: {e}')
+    return datafile, errors
+
+
+def validate_files(filelist, nproc=4):
+    """Validate a list of data files in parallel.
+
+    Returns:
+        A tuple (valid, rejected) where `valid` is the list of valid files
+        and `rejected` is a dict {datafile: list of errors}.
+    """
+    if len(filelist) == 0:
+        return [], {}
+    with Pool(processes=min(nproc, len(filelist))) as pool:
+        results = pool.map(validate, filelist)
+    valid = [f for f, errors in results if len(errors) == 0]
+    rejected = {f: errors for f, errors in results if len(errors) > 0}
+    return valid, rejected
+
+
+def log_report(rejected):
+    """Log a consolidated report of the rejected files."""
+    if len(rejected) == 0:
+        log.info('- Pre-flight check: all files are valid.')
+        return
+    lines = ['- Pre-flight check: the following %d file(s) are rejected:'
+             % len(rejected)]
+    for datafile, errors in rejected.items():
+        lines.append('  %s' % datafile)
+        lines += ['    * %s' % error for error in errors]
+    log.warning('\n'.join(lines))
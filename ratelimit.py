@@ -0,0 +1,152 @@
+"""
+Token-bucket rate limiter for copying data from the acquisition share.
+
+A `TokenBucket` keeps its state in shared memory, so a single bucket created
+in the parent process can be passed to all the pool workers (for example
+through the `Pool` initializer). All the workers copying from the same source
+mount then share one global bandwidth budget.
+
+The rate of a bucket can be changed at any time (also from the parent
+process) with `TokenBucket.set_rate()`. `GrowingFileWatcher` can be used to
+switch between a "idle" and a "busy" rate depending on whether the
+acquisition software is still writing data files.
+"""
+
+import os
+import shutil
+import time
+from pathlib import Path
+import multiprocessing as mp
+
+
+MB = 1024**2
+
+default_chunk_size = 4 * MB
+
+
+class TokenBucket:
+    """Process-shared token bucket limiting the throughput in bytes/s.
+
+    Arguments:
+        rate (float or None): max average throughput in bytes/s.
+            If None, the throughput is not limited.
+        burst (float or None): max number of bytes that can be consumed
+            without waiting after an idle period. If None, use 1 second
+            worth of data at the current rate.
+    """
+    def __init__(self, rate=None, burst=None):
+        self._lock = mp.Lock()
+        self._rate = mp.RawValue('d', 0)
+        self._burst = mp.RawValue('d', 0)
+        self._tokens = mp.RawValue('d', 0)
+        self._last = mp.RawValue('d', time.monotonic())
+        self.set_rate(rate, burst)
+
+    @property
+    def rate(self):
+        """Current rate in bytes/s (None means unlimited)."""
+        rate = self._rate.value
+        return rate if rate > 0 else None
+
+    def set_rate(self, rate, burst=None):
+        """Change the rate (bytes/s) of the bucket. None means unlimited."""
+        with self._lock:
+            self._refill()
+            was_unlimited = self._rate.value <= 0
+            self._rate.value = 0 if rate is None else float(rate)
+            if burst is None:
+                burst = self._rate.value
+            self._burst.value = float(burst)
+            tokens = min(self._tokens.value, self._burst.value)
+            if was_unlimited or rate is None:
+                # Debt accumulated at a previous limited rate is not
+                # carried over an unlimited period
+                tokens = max(0, tokens)
+            self._tokens.value = tokens
+
+    def _refill(self):
+        # Must be called with the lock held
+        now = time.monotonic()
+        elapsed = now - self._last.value
+        self._last.value = now
+        if self._rate.value > 0:
+            self._tokens.value = min(self._burst.value,
+                                     self._tokens.value + elapsed * self._rate.value)
+
+    def consume(self, nbytes):
+        """Take `nbytes` tokens from the bucket, sleeping if needed.
+
+        Tokens are always taken immediately (the bucket can go in "debt"),
+        then the caller sleeps until the debt is repaid. This keeps the
+        order of requests from different workers fair without polling.
+
+        Returns:
+            The time (seconds) spent waiting.
+        """
+        with self._lock:
+            self._refill()
+            if self._rate.value <= 0:
+                return 0
+            self._tokens.value -= nbytes
+            wait = max(0, -self._tokens.value / self._rate.value)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class GrowingFileWatcher:
+    """Detect data files which are still being written in a folder.
+
+    Arguments:
+        folder (Path): folder to be watched.
+        glob (string): pattern of the data files to be watched.
+    """
+    def __init__(self, folder, glob='*.dat'):
+        self.folder = Path(folder)
+        self.glob = glob
+        self._sizes = self._get_sizes()
+
+    def _get_sizes(self):
+        sizes = {}
+        for f in self.folder.glob(self.glob):
+            try:
+                sizes[f] = f.stat().st_size
+            except FileNotFoundError:
+                pass
+        return sizes
+
+    def growing(self):
+        """Return a list of files grown (or appeared) since the last call."""
+        sizes = self._get_sizes()
+        grown = [f for f, size in sizes.items()
+                 if size != self._sizes.get(f, 0)]
+        self._sizes = sizes
+        return grown
+
+
+def throttled_copy(source, dest, bucket, chunk_size=default_chunk_size):
+    """Copy `source` to `dest` limiting the throughput with `bucket`.
+
+    The file content is copied in chunks of `chunk_size` bytes, then
+    permissions and timestamps are copied as done by `cp -a`.
+
+    Returns:
+        A tuple (nbytes, duration, waited) with the number of bytes copied,
+        the total copy time and the time spent waiting for the rate limiter.
+    """
+    nbytes, waited = 0, 0
+    start = time.monotonic()
+    buffer = bytearray(chunk_size)
+    with open(source, 'rb') as fsrc, open(dest, 'wb') as fdst:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fsrc.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        view = memoryview(buffer)
+        while True:
+            size = fsrc.readinto(buffer)
+            if size == 0:
+                break
+            waited += bucket.consume(size)
+            fdst.write(view[:size])
+            nbytes += size
+    shutil.copystat(source, dest)
+    return nbytes, time.monotonic() - start, waited
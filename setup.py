@@ -19,7 +19,7 @@ setup(
     author_email='tritemio@gmail.com',
     url='https://github.com/multispot-software/transfer_convert',
     download_url='https://github.com/multispot-software/transfer_convert',
-    install_requires=['phconvert', 'ipython', 'nbconvert'],
+    install_requires=['phconvert', 'ipython', 'nbconvert', 'pyyaml'],
     license='MIT',
     description="Automated Photon-HDF5 conversion and analysis of smFRET data.",
     long_description=long_description,
@@ -31,7 +31,8 @@ setup(
                  'Topic :: Scientific/Engineering',
                  ],
     py_modules=['nbrun', 'analyze', 'transfer', 'batch_convert',
-                'batch_analyze'],
+                'batch_analyze', 'ratelimit', 'preflight', 'staging',
+                'prefetch', 'joblog', 'status', 'capacity'],
     scripts=['analyze.py', 'transfer.py', 'batch_analyze.py', 'batch_convert.py'],
     #zip_safe = False,
 )
@@ -0,0 +1,105 @@
+"""
+Decide whether to stage a data file on the ramdisk before conversion.
+
+Copying the data file to the ramdisk costs a full read of the source, but
+then the conversion and the archive copy read from fast memory. Without
+staging, the conversion reads the source directly (read-only) and the
+archive copy reads the source a second time. Here we measure the source read
+throughput and compare the estimated I/O time of the two strategies.
+Staging is also skipped when the ramdisk does not have enough free space.
+"""
+
+import os
+import time
+import shutil
+
+from ratelimit import MB
+
+
+ramdisk_throughput = 2000 * MB   # Read throughput of the ramdisk (bytes/s)
+staging_overhead = 1.0           # Fixed cost of staging a file (seconds)
+ramdisk_margin = 2.5             # Min free ramdisk space as multiple of file size
+sample_size = 64 * MB            # Bytes read to measure the source throughput
+
+
+def measure_read_throughput(path, nbytes=sample_size, chunk_size=4 * MB,
+                            bucket=None):
+    """Measure the sequential read throughput (bytes/s) of a file.
+
+    Reads the first `nbytes` of the file. When available, the page cache for
+    the file is dropped before the measurement so that a previous read does
+    not inflate the result. If `bucket` (a `ratelimit.TokenBucket`) is not
+    None, the bytes read are taken from it like any other copy from the
+    source. The time spent waiting for the bucket is not measured.
+    """
+    buffer = bytearray(chunk_size)
+    nread, waited = 0, 0
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        start = time.monotonic()
+        while nread < nbytes:
+            size = f.readinto(buffer)
+            if size == 0:
+                break
+            nread += size
+            if bucket is not None:
+                waited += bucket.consume(size)
+        duration = time.monotonic() - start - waited
+    return nread / max(duration, 1e-6)
+
+
+def choose_staging(fname, temp_dir, read_passes=1, bucket=None, measure=True):
+    """Decide whether `fname` should be copied to `temp_dir` for conversion.
+
+    Arguments:
+        fname (Path): data file to be converted.
+        temp_dir (Path): folder on the ramdisk where the file would be copied.
+        read_passes (int): number of times the conversion reads the data file.
+        bucket (TokenBucket or None): rate limiter for the source. When
+            its rate is limited, the file is staged (if it fits): the copy
+            is throttled while an in-place conversion would read the source
+            at full speed. The measurement reads are also taken from it.
+        measure (bool): if False, do not read the source and only use
+            the file size and the ramdisk free space to decide.
+
+    Returns:
+        A tuple (stage, info) where `stage` is True if the file should be
+        copied to the ramdisk, and `info` is a dict with the quantities
+        used for the decision.
+    """
+    size = fname.stat().st_size
+    temp_dir.mkdir(parents=True, exist_ok=True)
+    info = dict(size=size, ramdisk_free=shutil.disk_usage(temp_dir).free)
+    if info['ramdisk_free'] < size * ramdisk_margin:
+        info['reason'] = 'ramdisk free space too low'
+        return False, info
+    if bucket is not None and bucket.rate is not None:
+        info['reason'] = 'source rate-limited'
+        return True, info
+    if not measure:
+        info['reason'] = 'throughput not measured'
+        return True, info
+
+    source_rate = measure_read_throughput(fname, bucket=bucket)
+    info['source_throughput'] = source_rate
+    # Staged: copy (1 source read), conversion and archive read the ramdisk
+    info['staged_time'] = (staging_overhead + size / source_rate +
+                           (read_passes + 1) * size / ramdisk_throughput)
+    # In place: conversion and archive copy both read the source
+    info['inplace_time'] = (read_passes + 1) * size / source_rate
+    stage = info['staged_time'] < info['inplace_time']
+    info['reason'] = 'estimated time'
+    return stage, info
+
+
+def format_info(info):
+    """Return a one-line string describing a staging decision."""
+    items = ['%.1f MB' % (info['size'] / MB),
+             'ramdisk free %.0f MB' % (info['ramdisk_free'] / MB)]
+    if 'source_throughput' in info:
+        items += ['source %.1f MB/s' % (info['source_throughput'] / MB),
+                  'staged %.1f s' % info['staged_time'],
+                  'in place %.1f s' % info['inplace_time']]
+    return '%s (%s)' % (info['reason'], ', '.join(items))
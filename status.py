@@ -0,0 +1,293 @@
+"""
+Live progress, throughput and ETA of batch and monitor sessions.
+
+Workers report the start and the end of each job (a data file) and of each
+processing stage (copy, convert, ...) using `report()` and `stage()`. These
+events are sent as log records through the `joblog` queue, so no extra
+inter-process communication is needed. In the main process, a
+`StatusTracker` (added as handler to the log listener) aggregates the
+events and shows a progress bar. The status can be also written to a JSON
+file and served as JSON by a local HTTP server, so that a batch can be
+monitored without attaching to its terminal.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque, defaultdict
+from contextlib import contextmanager
+
+from ratelimit import MB
+
+
+log = logging.getLogger(__name__)
+
+
+def report(event, stage=None, nbytes=0, duration=None, job=None, kind=None):
+    """Report a status event: job_queued, job_start, job_end, job_failed,
+    stage_start, stage_end or stage_failed.
+
+    Events are logged (level DEBUG) with additional attributes read by
+    `StatusTracker` and `capacity.TimingRecorder`. If `job` is None, the
+    current job name is used (see `joblog.job()`). `kind` is the type
+    (extension) of the data file.
+    """
+    extra = dict(status_event=event, status_stage=stage,
+                 status_nbytes=nbytes, status_duration=duration,
+                 status_kind=kind)
+    if job is not None:
+        extra['job'] = job
+    msg = 'Status: %s' % event
+    if stage is not None:
+        msg += ' %s' % stage
+    if duration is not None:
+        msg += ' (%.1f s)' % duration
+    log.debug(msg, extra=extra)
+
+
+@contextmanager
+def stage(name, nbytes=0, kind=None):
+    """Context manager reporting start, end and duration of a stage."""
+    report('stage_start', name, nbytes, kind=kind)
+    start = time.monotonic()
+    try:
+        yield
+    except BaseException:
+        report('stage_failed', name, nbytes, time.monotonic() - start,
+               kind=kind)
+        raise
+    report('stage_end', name, nbytes, time.monotonic() - start, kind=kind)
+
+
+class StatusTracker(logging.Handler):
+    """Log handler aggregating the status events of a batch.
+
+    Arguments:
+        nproc (int or dict): number of workers, used to compute the ETA.
+            A dict {resource class: number of workers} describes separate
+            pools running in parallel, see `resource_classes`.
+        resource_classes (dict or None): resource class of each file type
+            (extension), used when `nproc` is a dict. The file type of a
+            job is the `kind` of its job_queued event.
+        status_file (Path or None): if not None, JSON file where the status
+            is periodically saved.
+        port (int or None): if not None, serve the status as JSON on
+            http://localhost:<port>/.
+        progress (bool): if True, show a progress bar (requires tqdm).
+        window (float): time window (seconds) for the rolling throughput.
+        interval (float): update period (seconds) of the status file and
+            progress bar.
+    """
+    def __init__(self, nproc=4, status_file=None, port=None, progress=True,
+                 window=3600, interval=5, resource_classes=None):
+        super().__init__(level=logging.DEBUG)
+        self.nprocs = nproc if isinstance(nproc, dict) else {None: nproc}
+        self.resource_classes = resource_classes or {}
+        self.status_file = status_file
+        self.port = port
+        self.progress = progress
+        self.window = window
+        self.interval = interval
+        self.start_time = time.time()
+        self.last_event_time = None
+        self.num_queued = 0
+        self.num_completed = 0
+        self.num_failed = 0
+        self.running = {}                       # {job: (start time, stage)}
+        self.stage_stats = defaultdict(lambda: [0, 0., 0])  # [count, time, bytes]
+        self.job_classes = {}                   # {job: resource class}
+        self.class_counts = defaultdict(lambda: [0, 0])     # [queued, done]
+        self.job_durations = defaultdict(lambda: deque(maxlen=100))
+        self.completions = deque()              # (end time, nbytes)
+        self._lock = threading.RLock()
+        self._stop_event = threading.Event()
+        self._bar = None
+        self._server = None
+
+    def emit(self, record):
+        event = getattr(record, 'status_event', None)
+        if event is None:
+            return
+        job, stage_name = record.job, record.status_stage
+        now = time.time()
+        with self._lock:
+            self.last_event_time = now
+            if event == 'job_queued':
+                self.num_queued += 1
+                res_class = self._get_class(getattr(record, 'status_kind',
+                                                    None))
+                self.job_classes[job] = res_class
+                self.class_counts[res_class][0] += 1
+            elif event == 'job_start':
+                self.running[job] = (now, None)
+            elif event in ('job_end', 'job_failed'):
+                job_start, _ = self.running.pop(job, (now, None))
+                res_class = self.job_classes.pop(job, self._get_class(None))
+                self.class_counts[res_class][1] += 1
+                if event == 'job_end':
+                    self.num_completed += 1
+                    self.job_durations[res_class].append(now - job_start)
+                    self.completions.append((now, record.status_nbytes))
+                else:
+                    self.num_failed += 1
+                self._update_bar()
+            elif event == 'stage_start':
+                job_start, _ = self.running.get(job, (now, None))
+                self.running[job] = (job_start, stage_name)
+            elif event == 'stage_end':
+                stats = self.stage_stats[stage_name]
+                stats[0] += 1
+                stats[1] += record.status_duration
+                stats[2] += record.status_nbytes
+
+    def _get_class(self, kind):
+        # Resource class of a file type (the first class if unknown)
+        res_class = self.resource_classes.get(kind)
+        return res_class if res_class in self.nprocs else next(iter(self.nprocs))
+
+    def _get_eta(self, now, stages):
+        # Must be called with the lock held. Pools of different resource
+        # classes run in parallel: the ETA is the one of the slowest pool.
+        all_durations = [t for durations in self.job_durations.values()
+                         for t in durations]
+        eta = None
+        for res_class, nproc in self.nprocs.items():
+            queued, done = self.class_counts[res_class]
+            running = [job_start for job, (job_start, _) in self.running.items()
+                       if self.job_classes.get(job, self._get_class(None))
+                       == res_class]
+            num_waiting = max(0, queued - done - len(running))
+            if num_waiting + len(running) == 0:
+                continue
+            # Mean job duration from completed jobs (of this class if any)
+            # or, before the first job completes, from the stages completed
+            # so far
+            durations = self.job_durations[res_class] or all_durations
+            if len(durations) > 0:
+                job_mean = sum(durations) / len(durations)
+            elif len(stages) > 0:
+                job_mean = sum(s['mean_duration'] for s in stages.values())
+            else:
+                return None
+            remaining = num_waiting * job_mean + sum(
+                max(0, job_mean - (now - job_start)) for job_start in running)
+            class_eta = remaining / max(1, min(nproc, num_waiting +
+                                               len(running)))
+            eta = class_eta if eta is None else max(eta, class_eta)
+        return eta
+
+    def snapshot(self):
+        """Return a dict with the current status."""
+        now = time.time()
+        with self._lock:
+            while self.completions and self.completions[0][0] < now - self.window:
+                self.completions.popleft()
+            in_flight = defaultdict(int)
+            for job_start, stage_name in self.running.values():
+                in_flight[stage_name or 'starting'] += 1
+            num_waiting = (self.num_queued - self.num_completed -
+                           self.num_failed - len(self.running))
+            window = min(self.window, now - self.start_time)
+            files_per_hour = len(self.completions) / max(window, 1) * 3600
+            mbytes_per_s = (sum(nbytes for t, nbytes in self.completions) /
+                            max(window, 1) / MB)
+            stages = {name: dict(count=count, mean_duration=t / count,
+                                 throughput_MBps=nbytes / max(t, 1e-6) / MB)
+                      for name, (count, t, nbytes) in self.stage_stats.items()}
+            eta = self._get_eta(now, stages)
+            return dict(
+                updated=time.ctime(now),
+                elapsed=now - self.start_time,
+                seconds_since_last_event=(None if self.last_event_time is None
+                                          else now - self.last_event_time),
+                total=self.num_queued,
+                waiting=num_waiting,
+                in_flight=dict(in_flight),
+                completed=self.num_completed,
+                failed=self.num_failed,
+                files_per_hour=files_per_hour,
+                throughput_MBps=mbytes_per_s,
+                stages=stages,
+                eta=eta)
+
+    def _update_bar(self):
+        if self._bar is None:
+            return
+        status = self.snapshot()
+        self._bar.total = status['total']
+        self._bar.n = status['completed'] + status['failed']
+        in_flight = ' '.join('%s:%d' % item
+                             for item in sorted(status['in_flight'].items()))
+        self._bar.set_postfix_str(
+            'failed %d, waiting %d, %s, %.1f files/h, %.1f MB/s, ETA %s' %
+            (status['failed'], status['waiting'], in_flight or 'idle',
+             status['files_per_hour'], status['throughput_MBps'],
+             '?' if status['eta'] is None else
+             time.strftime('%H:%M:%S', time.gmtime(status['eta']))))
+
+    def write_status_file(self):
+        """Save the status in `status_file` (atomic replace)."""
+        tmp_fname = str(self.status_file) + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(tmp_fname, str(self.status_file))
+
+    def _start_server(self):
+        from socketserver import ThreadingMixIn
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        tracker = self
+
+        # Same as http.server.ThreadingHTTPServer (Python 3.7+)
+        class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        class StatusRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(tracker.snapshot(), indent=2).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('localhost', self.port),
+                                           StatusRequestHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        log.info('- Status available at http://localhost:%d/' % self.port)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            with self._lock:
+                self._update_bar()
+            if self.status_file is not None:
+                self.write_status_file()
+
+    def start(self):
+        """Start the progress bar, the status file and the HTTP server."""
+        if self.progress:
+            try:
+                from tqdm import tqdm
+            except ImportError:
+                log.warning('tqdm not found, progress bar disabled.')
+            else:
+                self._bar = tqdm(total=0, unit='file', dynamic_ncols=True)
+        if self.port is not None:
+            self._start_server()
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self.status_file is not None:
+            self.write_status_file()
+        if self._server is not None:
+            self._server.shutdown()
+        if self._bar is not None:
+            with self._lock:
+                self._update_bar()
+            self._bar.close()
@@ -5,9 +5,14 @@ import os
 from pathlib import Path
 import subprocess as sp
 import time
+import logging
 
 from nbrun import run_notebook
 from analyze import run_analysis, default_notebook_name
+from ratelimit import TokenBucket, throttled_copy, MB
+import staging
+import joblog
+import status
 
 
 convert_notebook_name_tempfile = 'Convert to Photon-HDF5 48-spot smFRET from YAML - tempfile.ipynb'
@@ -19,24 +24,85 @@ temp_basedir = '/mnt/ramdisk/'                    # Local temp dir with very fas
 local_archive_basedir = '/mnt/archive/Antonio/'   # Local dir for archiving data
 remote_archive_basedir = '/mnt/wAntonio/'         # Remote dir for archiving data
 
+# Max copy bandwidth (bytes/s) for each source mount: (idle_rate, busy_rate).
+# `busy_rate` is used while the acquisition is still writing a data file
+# in the monitored folder, `idle_rate` otherwise. None means no limit.
+copy_rate_limits = {remote_origin_basedir: (None, 40 * MB)}
+
+# Number of times each conversion notebook reads the input data file
+conversion_read_passes = {convert_notebook_name_inplace: 1,
+                          convert_notebook_name_tempfile: 1,
+                          convert_notebook_name_singlespot: 1}
+
 DRY_RUN = False     # Set to True for a debug dry-run
 
+# Rate limiters (TokenBucket) for each source mount, shared by all the workers
+rate_limiters = {}
+
+log = logging.getLogger(__name__)
+
+
+def make_rate_limiters(rate_limits=None):
+    """Create a shared `TokenBucket` for each source mount.
+
+    Buckets start at the "idle" rate. The returned dict needs to be passed
+    to `init_worker()` in each worker process.
+    """
+    if rate_limits is None:
+        rate_limits = copy_rate_limits
+    return {basedir: TokenBucket(rate=idle_rate)
+            for basedir, (idle_rate, busy_rate) in rate_limits.items()}
+
+
+def init_worker(limiters, log_queue=None):
+    """Initializer for pool workers: set the shared rate limiters and
+    send the log records to `log_queue` (see `joblog`)."""
+    rate_limiters.update(limiters)
+    joblog.init_worker(log_queue)
+
+
+def get_rate_limiter(path):
+    """Return the rate limiter for the mount containing `path` (or None)."""
+    for basedir, bucket in rate_limiters.items():
+        if str(path).startswith(basedir):
+            return bucket
+
 
 def timestamp():
-    print('\n-- TIMESTAMP %s\n' % time.ctime(), flush=True)
+    log.debug('-- TIMESTAMP %s', time.ctime())
 
 
 def replace_basedir(path, orig_basedir, new_basedir):
     return Path(str(path.parent).replace(orig_basedir, new_basedir), path.name)
 
 
+def get_log_path(fname):
+    """Return the path of the log file for the source data file `fname`.
+
+    The log file is saved in the archive folder, next to the data file.
+    """
+    return replace_basedir(fname, remote_origin_basedir,
+                           local_archive_basedir).with_suffix('.log')
+
+
 def filecopy(source, dest, msg=''):
-    print('* Copying %s ...' % msg, flush=True)
-    if not DRY_RUN:
-        ret = sp.call(['cp', '-av', source, dest])
-    else:
+    log.debug('* Copying %s ...', msg)
+    bucket = get_rate_limiter(source)
+    if DRY_RUN:
         ret = 'DRY RUN'
-    print('  [DONE]. Return code %s\n' % ret, flush=True)
+    elif bucket is None:
+        res = sp.run(['cp', '-av', str(source), str(dest)], stdout=sp.PIPE,
+                     stderr=sp.STDOUT, universal_newlines=True)
+        log.debug(res.stdout.strip())
+        ret = res.returncode
+    else:
+        nbytes, duration, waited = throttled_copy(source, dest, bucket)
+        log.debug(f"'{source}' -> '{dest}' ({nbytes / MB:.1f} MB in "
+                  f"{duration:.1f} s, {waited:.1f} s throttled)")
+        ret = 0
+    if ret not in (0, 'DRY RUN'):
+        log.warning('Copying %s failed. Return code %s', msg, ret)
+    log.debug('  [DONE]. Return code %s', ret)
 
 
 def copy_files_to_ramdisk(fname, orig_basedir, dest_basedir=temp_basedir):
@@ -60,7 +126,8 @@ def copy_files_to_ramdisk(fname, orig_basedir, dest_basedir=temp_basedir):
     return dest_fname
 
 
-def copy_files_to_archive(h5_fname, orig_fname, nb_conv_fname):
+def copy_files_to_archive(h5_fname, orig_fname, nb_conv_fname,
+                          orig_basedir=temp_basedir):
     """
     Copy Photon-HDF5, YML, DAT, and conversion notebooks to archive folder.
 
@@ -68,6 +135,8 @@ def copy_files_to_archive(h5_fname, orig_fname, nb_conv_fname):
         h5_fname (Path): full path of HDF5 file to be copied into archive
         orig_fname (Path): full path of DAT file to be copied into archive
         nb_conv_fname (Path): full path of the executed conversion notebook
+        orig_basedir (string): base folder of `orig_fname`. This is the
+            temp folder, or the source folder when the file is not staged.
     """
     # Create destination folder if not existing and compute filenames
     dest_h5_fname = replace_basedir(h5_fname, temp_basedir, local_archive_basedir)
@@ -76,7 +145,7 @@ def copy_files_to_archive(h5_fname, orig_fname, nb_conv_fname):
     dest_nb_conv_fname = Path(dest_nb_conv_fname.parent, 'conversion',
                               dest_nb_conv_fname.name)
     dest_nb_conv_fname.parent.mkdir(exist_ok=True)
-    dest_orig_fname = replace_basedir(orig_fname, temp_basedir, local_archive_basedir)
+    dest_orig_fname = replace_basedir(orig_fname, orig_basedir, local_archive_basedir)
 
     # Copy HDF5 file
     filecopy(h5_fname, dest_h5_fname, msg='HDF5 file to archive')
@@ -94,20 +163,30 @@ def copy_files_to_archive(h5_fname, orig_fname, nb_conv_fname):
 
 
 def convert(filepath, basedir, conversion_notebook=convert_notebook_name_inplace,
-            suffix=None):
+            suffix=None, out_basedir=None):
     """
     Convert an input file to Photon-HDF5.
 
     Arguments:
         filepath (Path): full path of data file to be converted.
+        out_basedir (string or None): if not None, the output files are
+            saved in `out_basedir` (instead of the input folder) and the
+            notebook receives the additional `basedir` and `out_basedir`
+            arguments. Used to convert files in place on the source.
     """
-    print(f'* Converting to Photon-HDF5: {filepath.stem}', flush=True)
-    print(f"'-> Conversion notebook: {conversion_notebook}", flush=True)
+    log.info(f'* Converting to Photon-HDF5: {filepath.stem}')
+    log.debug(f"'-> Conversion notebook: {conversion_notebook}")
 
     # Compute input file name relative to the basedir
     # This is the format of the input file-name required by
     # 48-spot conversion notebook
     fname_nb_input = str(replace_basedir(filepath, basedir, ''))
+    nb_kwargs = {'fname': fname_nb_input}
+    out_dir = filepath.parent
+    if out_basedir is not None:
+        nb_kwargs.update(basedir=basedir, out_basedir=out_basedir)
+        out_dir = replace_basedir(filepath, basedir, out_basedir).parent
+        out_dir.mkdir(parents=True, exist_ok=True)
 
     # Name of the output notebook
     if suffix is None:
@@ -115,17 +194,21 @@ def convert(filepath, basedir, conversion_notebook=convert_notebook_name_inplace
             suffix = '_tf'
         else:
             suffix = ''
-    nb_out_path = Path(filepath.parent,
-                       filepath.stem + f'{suffix}_conversion.ipynb')
+    nb_out_path = Path(out_dir, filepath.stem + f'{suffix}_conversion.ipynb')
 
     # Convert file to Photon-HDF5
     if not DRY_RUN:
         run_notebook(conversion_notebook, out_path_ipynb=nb_out_path,
-                     nb_kwargs={'fname': fname_nb_input}, hide_input=False)
+                     nb_kwargs=nb_kwargs, hide_input=False)
 
-    print('  [COMPLETED CONVERSION] "{filepath.name}".\n', flush=True)
+    log.info(f'  [COMPLETED CONVERSION] "{filepath.name}".')
 
-    h5_fname = Path(filepath.parent, filepath.stem + f'{suffix}.hdf5')
+    h5_fname = Path(out_dir, filepath.stem + f'{suffix}.hdf5')
+    if out_basedir is not None and not DRY_RUN and not h5_fname.is_file():
+        raise FileNotFoundError(
+            f'Output file not found: {h5_fname}. The conversion notebook '
+            f'"{conversion_notebook}" may not support the `out_basedir` '
+            'argument, use staging_mode="always".')
     return h5_fname, nb_out_path
 
 
@@ -133,18 +216,16 @@ def remove_temp_files(dat_fname):
     """Remove temporary files."""
     # Safety checks
     folder = dat_fname.parent
+    assert remote_origin_basedir not in str(folder)
     assert remote_archive_basedir not in str(folder)
     assert local_archive_basedir not in str(folder)
-    print('* Removing temp files in "%s" (waiting 5 seconds to cancel) '
-          % folder, end='', flush=True)
+    # Shown in the console: the removal can be canceled with Ctrl-C
+    log.info('* Removing temp files in "%s" in 5 seconds (Ctrl-C to cancel)',
+             folder)
     try:
-        for i in range(1, 6):
-            time.sleep(1)
-            print('%d ' % i, end='', flush=True)
-        time.sleep(1)
-        print()
+        time.sleep(6)
     except KeyboardInterrupt:
-        print('\n- Removing files canceled!\n', flush=True)
+        log.warning('- Removing files canceled!')
     else:
         # Remove files
         if not DRY_RUN:
@@ -154,61 +235,117 @@ def remove_temp_files(dat_fname):
                 curr_file = Path(dat_fname.parent, dat_fname.stem + ext)
                 if curr_file.is_file():
                     os.remove(curr_file)
-        print(f'  [COMPLETED FILE REMOVAL] "{dat_fname.name}". \n' flush=True)
+        log.info(f'  [COMPLETED FILE REMOVAL] "{dat_fname.name}".')
+
+
+def stage_file(fname, conversion_notebook, staging_mode='always'):
+    """Return True if `fname` should be copied to the temp folder.
+
+    With `staging_mode='auto'` the decision is taken by
+    `staging.choose_staging()` and logged together with the measured numbers.
+    """
+    if staging_mode != 'auto':
+        return staging_mode == 'always'
+    temp_dir = replace_basedir(fname, remote_origin_basedir, temp_basedir).parent
+    bucket = get_rate_limiter(fname)
+    stage, info = staging.choose_staging(
+        fname, temp_dir, read_passes=conversion_read_passes.get(conversion_notebook, 1),
+        bucket=bucket, measure=not DRY_RUN)
+    log.info('* Staging decision: %s, %s',
+             'copy to ramdisk' if stage else 'convert in place',
+             staging.format_info(info))
+    return stage
 
 
 def process(fname, dry_run=False, analyze=True, analyze_kws=None, remove=True,
-            conversion_notebook=convert_notebook_name_inplace):
+            conversion_notebook=convert_notebook_name_inplace,
+            staging_mode='always'):
     """
     This is the main function for copying the input data file to the temp
     folder, converting it to Photon-HDF5, copying all the files to the
     archive folder and (optionally) running an analysis notebook.
+
+    When the copy to the temp folder does not pay off (see `stage_file()`),
+    the conversion reads the source file in place and only the output
+    files are written to the temp folder.
     """
     global DRY_RUN
     DRY_RUN = DRY_RUN or dry_run
 
     assert fname.is_file(), 'File not found: %s' % fname
 
-    print(f'\n\nPROCESSING: {fname.name}', flush=True)
+    log.info(f'PROCESSING: {fname.name}')
 
+    size, kind = fname.stat().st_size, fname.suffix
     timestamp()
     assert remote_origin_basedir in str(fname)
-    copied_fname = copy_files_to_ramdisk(fname, remote_origin_basedir,
-                                         temp_basedir)
-
-    timestamp()
-    assert temp_basedir in str(copied_fname)
-    h5_fname, nb_conv_fname = convert(copied_fname, temp_basedir,
-                                      conversion_notebook=conversion_notebook)
+    if stage_file(fname, conversion_notebook, staging_mode):
+        with status.stage('copy', size, kind):
+            copied_fname = copy_files_to_ramdisk(fname, remote_origin_basedir,
+                                                 temp_basedir)
+        timestamp()
+        assert temp_basedir in str(copied_fname)
+        with status.stage('convert', size, kind):
+            h5_fname, nb_conv_fname = convert(copied_fname, temp_basedir,
+                                              conversion_notebook=conversion_notebook)
+        orig_basedir = temp_basedir
+    else:
+        copied_fname = fname
+        timestamp()
+        # The notebook reads the source directly, bypassing the rate
+        # limiter: take its reads from the bucket before starting it
+        bucket = get_rate_limiter(fname)
+        if bucket is not None and not DRY_RUN:
+            waited = bucket.consume(
+                size * conversion_read_passes.get(conversion_notebook, 1))
+            if waited > 0:
+                log.info('* Waited %.1f s for the copy rate limit' % waited)
+        with status.stage('convert', size, kind):
+            h5_fname, nb_conv_fname = convert(fname, remote_origin_basedir,
+                                              conversion_notebook=conversion_notebook,
+                                              out_basedir=temp_basedir)
+        orig_basedir = remote_origin_basedir
 
     timestamp()
-    copy_files_to_archive(h5_fname, copied_fname, nb_conv_fname)
+    with status.stage('archive', size, kind):
+        copy_files_to_archive(h5_fname, copied_fname, nb_conv_fname,
+                              orig_basedir=orig_basedir)
 
     if remove:
         timestamp()
-        remove_temp_files(copied_fname)
+        with status.stage('remove', size, kind):
+            remove_temp_files(replace_basedir(copied_fname, orig_basedir,
+                                              temp_basedir))
 
     if analyze:
         timestamp()
         h5_fname_archive = replace_basedir(h5_fname, temp_basedir,
                                            local_archive_basedir)
         assert h5_fname_archive.is_file(), f'File not found: {h5_fname_archive}'
-        run_analysis(h5_fname_archive, dry_run=dry_run, **analyze_kws)
+        with status.stage('analyze', size, kind):
+            run_analysis(h5_fname_archive, dry_run=dry_run, **analyze_kws)
 
     timestamp()
     return fname
 
 
 def process_int(fname, dry_run=False, analyze=True, analyze_kws=None, 
-                remove=True, conversion_notebook=convert_notebook_name_inplace):
+                remove=True, conversion_notebook=convert_notebook_name_inplace,
+                staging_mode='always'):
     ret = None
-    try:
-        ret = process(fname, dry_run=dry_run, analyze=analyze, 
-                      analyze_kws=analyze_kws,
-                      conversion_notebook=conversion_notebook)
-    except Exception as e:
-        print(f'Worker for "{fname}" got exception:\n{str(e)}', flush=True)
-    print(f'Completed processing for "{fname}" (worker)', flush=True)
+    with joblog.job(fname.stem, get_log_path(fname)):
+        status.report('job_start')
+        try:
+            ret = process(fname, dry_run=dry_run, analyze=analyze, 
+                          analyze_kws=analyze_kws, remove=remove,
+                          conversion_notebook=conversion_notebook,
+                          staging_mode=staging_mode)
+        except Exception:
+            log.exception(f'Worker for "{fname}" got exception:')
+            status.report('job_failed')
+        else:
+            status.report('job_end', nbytes=fname.stat().st_size)
+        log.info(f'Completed processing for "{fname}" (worker)')
     return ret
 
 
@@ -239,6 +376,16 @@ if __name__ == '__main__':
                         default=default_notebook_name, help=msg)
     parser.add_argument('--working-dir', metavar='PATH', default=None,
                         help='Working dir for the kernel executing the notebook.')
+    msg = ("Copy the data file to the temp folder before conversion: "
+           "'always', 'never' (convert in place reading the source) or "
+           "'auto' (decide based on the measured source throughput). "
+           "'never' and 'auto' require a conversion notebook accepting "
+           "the `basedir` and `out_basedir` arguments. While the copy rate "
+           "is limited, 'auto' copies the file to the temp folder (if it "
+           "fits), and an in-place conversion waits for the rate limit as "
+           "if its reads were a copy. Default 'always'.")
+    parser.add_argument('--staging', choices=('auto', 'always', 'never'),
+                        default='always', help=msg)
     args = parser.parse_args()
 
     datafile = Path(args.datafile)
@@ -247,7 +394,12 @@ if __name__ == '__main__':
 
     analyze_kws = dict(input_notebook=args.notebook, save_html=args.save_html,
                        working_dir=args.working_dir)
-    process_int(datafile, dry_run=args.dry_run, 
-                analyze=args.analyze, analyze_kws=analyze_kws,
-                conversion_notebook=args.conversion_notebook)
-    print('Terminated processing of "%s"' % datafile, flush=True)
+    log_queue, listener = joblog.start_logging()
+    try:
+        process_int(datafile, dry_run=args.dry_run, 
+                    analyze=args.analyze, analyze_kws=analyze_kws,
+                    conversion_notebook=args.conversion_notebook,
+                    staging_mode=args.staging)
+        log.info('Terminated processing of "%s"' % datafile)
+    finally:
+        listener.stop()